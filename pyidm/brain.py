@@ -7,15 +7,23 @@
     :license: GNU LGPLv3, see LICENSE for more details.
 """
 import io
+import math
 import os
 import time
+from queue import Empty
 from threading import Thread
 from .video import merge_video_audio, unzip_ffmpeg, pre_process_hls, post_process_hls, \
     convert_audio  # unzip_ffmpeg required here for ffmpeg callback
 from . import config
 from .config import Status, active_downloads, APP_NAME
-from .utils import (log, size_format, popup, notify, delete_folder, delete_file, rename_file, load_json, save_json)
+from .utils import (log, size_format, popup, notify, delete_folder, delete_file, rename_file, load_json, save_json,
+                    append_file)
 from .worker import Worker
+from .engine import engine
+from .controller import ConnectionController, SegmentSizer, MirrorSelector
+from .scheduler import scheduler
+from .limiter import limiter
+from .decryption import decryptor, get_decrypted_file
 from .downloaditem import Segment
 
 
@@ -42,7 +50,6 @@ def brain(d=None, downloader=None):
 
     # experimental m3u8 protocols
     if 'hls' in d.subtype_list:
-        keep_segments = True  # don't delete segments after completed, it will be post-processed by ffmpeg
         try:
             success = pre_process_hls(d)
             if not success:
@@ -52,6 +59,9 @@ def brain(d=None, downloader=None):
             log('pre_process_hls()> error', e)
             d.status = Status.error
             return
+
+        # don't delete segments after completed, it will be post-processed by ffmpeg, unless they are concatenated
+        keep_segments = not d.hls_concat
     else:
         # for non hls videos and normal files
         keep_segments = False
@@ -59,6 +69,19 @@ def brain(d=None, downloader=None):
         # load previous saved progress info
         d.load_progress_info()
 
+        # create full size temp file for sparse segments
+        if not d.preallocate():
+            log('brain()> failed to create temp file for:', d.name)
+            d.status = Status.error
+            return
+
+        # check other sources of the same file
+        if d.mirrors:
+            d.validate_mirrors()
+
+    # save segments progress instantly while downloading
+    d.open_journal()
+
     # run file manager in a separate thread
     Thread(target=file_manager, daemon=True, args=(d, keep_segments)).start()
 
@@ -66,7 +89,9 @@ def brain(d=None, downloader=None):
     Thread(target=thread_manager, daemon=True, args=(d,)).start()
 
     while True:
-        time.sleep(0.1)  # a sleep time to make the program responsive
+        # block until status changed by file manager, or user
+        d.status_changed.wait()
+        d.status_changed.clear()
 
         if d.status == Status.completed:
             # os notification popup
@@ -95,61 +120,121 @@ def brain(d=None, downloader=None):
 def thread_manager(d):
     q = d.q
 
+    # with curl multi engine, all transfers will run in engine thread instead of a thread per worker
+    use_engine = config.download_engine == 'curl_multi'
+
+    # fragments of hls and fragmented videos can be downloaded as http2 streams multiplexed over few connections,
+    # number of concurrent streams is limited by "max_streams" instead of "max_connections"
+    multiplex = use_engine and config.http2_multiplex and ('hls' in d.subtype_list or bool(d.fragments))
+    concurrency = config.max_streams if multiplex else config.max_connections
+
     # create worker/connection list
-    workers = [Worker(tag=i, d=d) for i in range(config.max_connections)]
+    workers = [Worker(tag=i, d=d, multiplex=multiplex) for i in range(concurrency)]
+    d.add_counters(workers)
 
-    free_workers = [i for i in range(config.max_connections)]
+    free_workers = [i for i in range(concurrency)]
     free_workers.reverse()
     busy_workers = []
-    live_threads = []  # hold reference to live threads
+
+    # adaptive connections controller, None means fixed number of connections "max_connections"
+    controller = ConnectionController(d, max_connections=concurrency) if config.adaptive_connections else None
+
+    # resize not started segments based on measured speed
+    sizer = SegmentSizer(d) if config.auto_segment_size else None
+
+    # distribute segments of main stream over mirrors
+    mirrors = MirrorSelector(d, [d.eff_url] + d.valid_mirrors) if d.valid_mirrors else None
 
     # job_list
-    job_list = [seg for seg in d.segments if not seg.downloaded]
+    job_list = d.segments.pending()
     # print('thread manager job list:', job_list)
 
     # reverse job_list to process segments in proper order use pop()
     job_list.reverse()
 
-    while True:
-        time.sleep(0.1)  # a sleep time to while loop to make the app responsive
+    # connections are shared with other running downloads by scheduler, multiplexed streams share the same
+    # connection, so they are counted as connections not streams, up to "max_streams" streams per connection
+    streams_per_connection = config.max_streams if multiplex else 1
+    scheduler.register(d, demand=math.ceil(min(len(job_list), concurrency) / streams_per_connection))
+
+    # resume decrypting encrypted hls segments downloaded in a previous session
+    if d.hls_keys:
+        for seg in d.segments:
+            decryptor.submit(d, seg)
 
+    while True:
         # getting jobs which might be returned from workers as failed
         for _ in range(q.jobs.qsize()):
             job = q.jobs.get()
             job_list.append(job)
             # print('thread managaer jobs q:', job)
 
-        # speed limit
-        allowable_connections = min(config.max_connections, d.remaining_parts)
-        if allowable_connections:
-            worker_sl = config.speed_limit // allowable_connections
-        else:
-            worker_sl = 0
+        # apply speed limit settings changes to buckets used by workers
+        limiter.get_buckets(d)
+
+        # allowed number of connections
+        limit = controller.update(len(busy_workers)) if controller else concurrency
+
+        # number of connections we can use, remaining busy segments can be split to be downloaded by more connections
+        demand = len(busy_workers) + len(job_list) + q.jobs.qsize()
+        if config.dynamic_split:
+            demand += sum(workers[i].remaining // (2 * config.min_split_size) for i in busy_workers)
+
+        allowance = scheduler.allowance(d, math.ceil(min(demand, limit) / streams_per_connection))
+        max_connections = min(allowance * streams_per_connection, limit)
+
+        # no more jobs, split remaining ranges of busy workers' segments and give the second halves to free workers
+        if config.dynamic_split and free_workers and not job_list and d.status == Status.downloading:
+            busy = sorted([workers[i] for i in busy_workers], key=lambda w: w.remaining, reverse=True)
+            for worker in busy[:max(min(len(free_workers), max_connections - len(busy_workers)), 0)]:
+                seg = split_busy_segment(d, worker)
+                if seg:
+                    job_list.append(seg)
 
         # reuse a free worker to handle a job from job_list
         if free_workers and job_list and d.status == Status.downloading:
             for _ in free_workers[:]:
+                if len(busy_workers) >= max_connections:
+                    break
+
                 try:
                     worker_num, seg = free_workers.pop(), job_list.pop()  # get available tag # get a new job
+
+                    if sizer and sizer.segment_size:
+                        resize_segment(d, seg, sizer.segment_size, job_list)
+
                     busy_workers.append(worker_num)  # add number to busy workers
 
-                    # create new threads
                     worker = workers[worker_num]
-                    worker.reuse(seg=seg, speed_limit=worker_sl)
-                    t = Thread(target=worker.run, daemon=True, name=str(worker_num))
-                    live_threads.append(t)
-                    t.start()
+                    worker.reuse(seg=seg, url=mirrors.select() if mirrors and seg.url == d.eff_url else None)
+
+                    if use_engine:
+                        engine.add(worker)
+                    else:
+                        # create new threads
+                        t = Thread(target=worker.run, daemon=True, name=str(worker_num))
+                        t.start()
                 except:
                     break
 
-        # Monitor active threads and add the offline to a free_workers
-        for t in live_threads:
-            if not t.is_alive():
-                worker_num = int(t.name)
-                live_threads.remove(t)
+        # Monitor busy workers and add the finished to a free_workers
+        for worker_num in busy_workers[:]:
+            if not workers[worker_num].busy:
                 busy_workers.remove(worker_num)
                 free_workers.append(worker_num)
 
+                if controller:
+                    controller.report(workers[worker_num])
+
+                if sizer:
+                    sizer.report(workers[worker_num])
+
+                if mirrors:
+                    mirrors.report(workers[worker_num])
+
+                if d.hls_keys:
+                    decryptor.submit(d, workers[worker_num].seg)
+
         # update d param
         d.live_connections = len(busy_workers)
         d.remaining_parts = len(busy_workers) + len(job_list) + q.jobs.qsize()
@@ -164,44 +249,138 @@ def thread_manager(d):
             # print('--------------thread manager done----------------------')
             break
 
+        # sleep until a worker finish its job, timeout is required to check download status and take speed samples
+        wait_for(q.thread_mngr, timeout=1)
+
+    # release connections for other downloads
+    scheduler.unregister(d)
+
+    # wait for aborted transfers to stop before releasing workers' counters
+    timeout = time.time() + 5
+    while any(worker.busy for worker in workers) and time.time() < timeout:
+        wait_for(q.thread_mngr, timeout=0.1)
+
+    d.release_counters()
+
+    # keep curl handles of finished workers for reuse with their open connections
+    for worker in workers:
+        if not worker.busy:
+            worker.close()
+
     log(f'thread_manager {d.num}: quitting')
 
 
+def wait_for(q, timeout=None):
+    """block until any item is put in a queue or timeout passed, then clear the queue"""
+    try:
+        q.get(timeout=timeout)
+        for _ in range(q.qsize()):
+            q.get_nowait()
+    except Empty:
+        pass
+
+
+def is_fixed_segment(d, seg):
+    """return True if segment range must not be changed, i.e. hls byte range segments which are referenced by local
+    m3u8 file or decrypted one by one"""
+    return 'hls' in d.subtype_list and (not seg.merge or seg.name in d.hls_keys)
+
+
+def split_busy_segment(d, worker):
+    """split the remaining range of a segment being downloaded by a worker into two halves
+    return a new segment for the second half or None if it is too small to split"""
+    seg = worker.seg
+    if not worker.busy or not seg or not seg.range or not seg.size or seg.downloaded or is_fixed_segment(d, seg):
+        return None
+
+    remaining = worker.remaining
+    if remaining < 2 * config.min_split_size:
+        return None
+
+    new_seg = d.split_segment(seg, worker.current_filesize + remaining // 2)
+    if new_seg:
+        log('split segment:', os.path.basename(seg.name), 'new range:', seg.range, '- new segment:',
+            os.path.basename(new_seg.name), 'range:', new_seg.range, log_level=2)
+
+    return new_seg
+
+
+def resize_segment(d, seg, size, job_list):
+    """split or grow a not started segment to get close to a given size, job_list will be updated accordingly"""
+    if not seg.range or not seg.size or seg.started or is_fixed_segment(d, seg):
+        return
+
+    # too big, split and put the remaining part back on top of job_list
+    if seg.size > size * 2:
+        new_seg = d.split_segment(seg, size)
+        if new_seg:
+            job_list.append(new_seg)
+
+    # too small, join following segments which are waiting in job_list
+    elif seg.size * 2 < size:
+        while seg.size < size:
+            next_seg = d.next_segment(seg)
+            if next_seg is None or next_seg not in job_list or next_seg.size + seg.size > size * 2:
+                break
+
+            if not d.join_segments(seg, next_seg):
+                break
+
+            job_list.remove(next_seg)
+
+
 def file_manager(d, keep_segments=False):
+    q = d.q
 
     while True:
-        time.sleep(0.1)
+        segments = d.segments
 
-        job_list = [seg for seg in d.segments if not seg.completed]
-        # print(job_list)
+        # opened target files, key: file name, value: file object, to avoid re-opening same file for every segment
+        targets = {}
 
-        for seg in job_list:
-            # process segments in order
+        while True:
+            # process segments in order, starting from first non completed segment
+            seg = segments.next_to_merge()
 
-            if seg.completed:  # skip completed segment
-                continue
-
-            if not seg.downloaded:  # if the first non completed segments is not downloaded will exit for loop
+            # all segments completed, or next segment is not downloaded or decrypted yet
+            if seg is None or not seg.downloaded or (seg.name in d.hls_keys and not seg.decrypted):
                 break
 
             # append downloaded segment to temp file, mark as completed, then delete it.
             try:
                 if seg.merge:
-                    with open(seg.tempfile, 'ab') as trgt_file:
-                        with open(seg.name, 'rb') as src_file:
-                            trgt_file.write(src_file.read())
+                    trgt_file = targets.get(seg.tempfile)
+                    if not trgt_file:
+                        # "append mode" is not used since zero-copy functions don't support it
+                        trgt_file = open(seg.tempfile, 'r+b' if os.path.isfile(seg.tempfile) else 'wb')
+                        trgt_file.seek(0, os.SEEK_END)
+                        targets[seg.tempfile] = trgt_file
+
+                    # encrypted hls segments are merged from their decrypted files
+                    source = get_decrypted_file(seg.name) if seg.name in d.hls_keys else seg.name
+
+                    # merged bytes will be saved with completed flag, used to verify hls stream files when resuming
+                    seg.written = os.path.getsize(source)
+                    append_file(source, trgt_file, buffer_size=config.merge_buffer_size)
 
                 seg.completed = True
                 log('>> completed segment: ',  os.path.basename(seg.name))
 
                 if not keep_segments:
                     delete_file(seg.name)
+                    if seg.name in d.hls_keys:
+                        delete_file(get_decrypted_file(seg.name))
 
             except Exception as e:
                 log('failed to merge segment', seg.name, ' - ', e)
+                break
+
+        for trgt_file in targets.values():
+            trgt_file.close()
 
         # all segments already merged
-        if not job_list:
+        if segments.next_to_merge() is None:
+            d.save_progress_info()
 
             # handle audio streams
             if d.type == 'audio':
@@ -264,6 +443,9 @@ def file_manager(d, keep_segments=False):
             # print('--------------file manager cancelled-----------------')
             break
 
+        # sleep until a segment get downloaded
+        wait_for(q.completed_jobs, timeout=1)
+
     # save progress info for future resuming
     if d.status != Status.completed:
         d.save_progress_info()
@@ -62,16 +62,50 @@ all_themes = []
 monitor_clipboard = True
 show_download_window = True
 auto_close_download_window = True
-segment_size = DEFAULT_SEGMENT_SIZE  # in bytes
+segment_size = DEFAULT_SEGMENT_SIZE  # in bytes, used when auto_segment_size is disabled
+auto_segment_size = True  # choose segment size based on file size, connections, and measured speed, segment_size
+# will be ignored, it is disabled when user sets a segment size
+min_segment_size = DEFAULT_SEGMENT_SIZE  # in bytes, limits for auto segment size
+max_segment_size = 64 * 1024 * 1024
+segments_per_connection = 4  # initial number of segments for each connection
+min_segment_time = 2  # in seconds, minimum download time for a segment
+ttfb_ratio = 20  # segment download time should be at least this ratio multiplied by time to first byte
+sparse_file = False  # write segments directly into a preallocated temp file instead of merging segment files
+merge_buffer_size = 1024 * 1024  # in bytes, chunk size used when merging segment files without zero-copy support
+journal_sync_size = 4 * 1024 * 1024  # in bytes, save sparse segment progress to journal every n bytes
+write_buffer_size = 1024 * 1024  # in bytes, collect received data in memory before writing to disk, 0=disabled
+curl_buffer_size = 128 * 1024  # in bytes, curl receive buffer, max size of a chunk passed to write callback
+hls_concat = True  # join unencrypted hls segments while downloading, ffmpeg will only change container if needed
+hls_decrypt = True  # decrypt AES-128 hls segments while downloading, requires pycryptodome
+max_decrypt_workers = 2  # number of threads used to decrypt hls segments
+dynamic_split = True  # split remaining range of slow segments to be downloaded by free connections
+min_split_size = 1024 * 1024  # in bytes, minimum size of a new segment created by splitting
 show_thumbnail = True  # auto preview video thumbnail at main tab
 process_big_playlist_on_demand = True  # fetch videos info only if selected, since big playlist consume time/resources.
 big_playlist_length = 50  # define minimum number of videos in big playlist
 manually_select_dash_audio = False  # if True, will prompt user to select audio format for dash video
 
 # connection / network
-speed_limit = 0  # in bytes, zero == no limit
+speed_limit = 0  # in bytes/sec for all downloads, zero == no limit
+speed_limit_schedule = []  # speed limits by time of day, list of [start, end, limit] i.e. [['08:00', '17:00', 102400]]
 max_concurrent_downloads = DEFAULT_CONCURRENT_CONNECTIONS
 max_connections = DEFAULT_CONNECTIONS
+adaptive_connections = False  # ramp up connections while download speed improves, max_connections is the upper limit
+adaptive_start_connections = 2
+adaptive_interval = 3  # in seconds, time between throughput samples
+adaptive_threshold = 0.05  # minimum speed improvement ratio to add one more connection
+download_engine = 'threads'  # 'threads': thread per connection, 'curl_multi': all connections driven by one thread
+curl_pool_size = 4  # max. number of idle curl handles kept open for reuse per server
+max_header_probes = 8  # max. number of concurrent headers requests, i.e. to get sizes of video streams
+headers_cache_ttl = 300  # in seconds, reuse headers of the same url within this time, 0 = disabled
+headers_cache_negative_ttl = 10  # in seconds, for failed requests
+headers_cache_size = 256  # max. number of cached urls
+m3u8_cache_size = 16  # max. number of parsed m3u8 playlists kept in memory
+http2_multiplex = False  # fetch fragments of hls / fragmented videos as http2 streams over few connections
+max_streams = 32  # max. concurrent fragment streams for a single download when http2_multiplex is enabled
+max_host_connections = 0  # max. connections per server, 0 = no limit
+mirror_max_failures = 3  # drop a mirror after this number of consecutive failed transfers
+total_connections = 0  # connections budget shared by all running downloads, 0 = max_connections * concurrent downloads
 use_referer = False
 referer_url = ''  # referer website url
 
@@ -124,10 +158,13 @@ main_window_q = Queue()  # queue for Main application window
 
 # settings parameters to be saved on disk
 settings_keys = ['current_theme', 'monitor_clipboard', 'show_download_window', 'auto_close_download_window',
-                 'segment_size', 'show_thumbnail', 'speed_limit', 'max_concurrent_downloads', 'max_connections',
-                 'update_frequency', 'last_update_check', 'proxy', 'proxy_type', 'raw_proxy', 'enable_proxy',
-                 'log_level', 'download_folder', 'process_big_playlist_on_demand', 'manually_select_dash_audio',
-                 'use_referer', 'referer_url']
+                 'segment_size', 'show_thumbnail', 'speed_limit', 'speed_limit_schedule', 'max_concurrent_downloads',
+                 'max_connections', 'update_frequency', 'last_update_check', 'proxy', 'proxy_type', 'raw_proxy',
+                 'enable_proxy', 'log_level', 'download_folder', 'process_big_playlist_on_demand',
+                 'manually_select_dash_audio', 'use_referer', 'referer_url', 'download_engine',
+                 'sparse_file', 'merge_buffer_size', 'write_buffer_size', 'curl_buffer_size', 'dynamic_split',
+                 'min_split_size', 'adaptive_connections', 'auto_segment_size', 'http2_multiplex', 'max_streams',
+                 'hls_concat', 'hls_decrypt']
 
 # -------------------------------------------------------------------------------------
 
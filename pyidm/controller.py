@@ -0,0 +1,193 @@
+"""
+    pyIDM
+
+    multi-connections internet download manager, based on "pyCuRL/curl", "youtube_dl", and "PySimpleGUI"
+
+    :copyright: (c) 2019-2020 by Mahmoud Elshahat.
+    :license: GNU LGPLv3, see LICENSE for more details.
+"""
+
+# adaptive controllers for number of connections and segment size
+import time
+
+from . import config
+from .utils import log
+
+
+class ConnectionController:
+    """decide number of connections for a single download based on measured throughput,
+    it ramps up connections one by one as long as total download speed improves, and backs off when server
+    refuses extra connections i.e. "429 too many requests", "503 service unavailable", or resets connections"""
+
+    throttle_codes = (429, 503)
+    reset_errors = ('reset', 'refused', 'recv failure', 'send failure')
+
+    def __init__(self, d, max_connections=None):
+        self.d = d
+        self.max_connections = max_connections or config.max_connections
+        self.limit = min(config.adaptive_start_connections, self.max_connections)
+
+        # throughput sampling
+        self.interval = config.adaptive_interval  # in seconds
+        self.sample_time = time.time()
+        self.sample_downloaded = d.downloaded
+        self.prev_speed = 0  # total speed measured at previous limit
+
+        # average speed per connection reported by curl for finished transfers
+        self.connection_speed = 0
+
+        self.last_action = None  # 'up', 'down', or None
+        self.hold_until = 0  # don't change limit before this time
+
+    def __repr__(self):
+        return f'ConnectionController(limit: {self.limit}/{self.max_connections})'
+
+    def report(self, worker):
+        """check finished worker transfer for server throttling and update average connection speed"""
+        error = str(worker.error).lower() if worker.error else ''
+
+        if worker.response_code in self.throttle_codes or any(x in error for x in self.reset_errors):
+            self.back_off(reason=worker.response_code or error)
+
+        # ignore very short transfers, their speed is dominated by connection time
+        elif worker.speed and worker.total_time >= 1:
+            if self.connection_speed:
+                self.connection_speed = 0.8 * self.connection_speed + 0.2 * worker.speed
+            else:
+                self.connection_speed = worker.speed
+
+    def back_off(self, reason=''):
+        """reduce number of connections by half"""
+        now = time.time()
+
+        # already reduced recently, wait for servers to calm down
+        if self.last_action == 'down' and now < self.hold_until:
+            return
+
+        self.limit = max(self.limit // 2, 1)
+        self.last_action = 'down'
+        self.hold_until = now + self.interval * 3
+        log(f'download {self.d.num}: server throttling ({reason}), reduce connections to:', self.limit, log_level=2)
+
+    def update(self, busy_connections):
+        """take a throughput sample, adjust and return allowed number of connections"""
+        now = time.time()
+        time_passed = now - self.sample_time
+
+        if time_passed < self.interval:
+            return self.limit
+
+        downloaded = self.d.downloaded
+        speed = (downloaded - self.sample_downloaded) / time_passed
+        self.sample_time, self.sample_downloaded = now, downloaded
+
+        # current limit is not fully used or limit recently changed, nothing to learn from this sample
+        if now < self.hold_until or busy_connections < self.limit:
+            self.prev_speed = speed
+            return self.limit
+
+        improved = speed > self.prev_speed * (1 + config.adaptive_threshold)
+
+        if self.last_action == 'up' and not improved:
+            # last added connection didn't improve total speed, throughput flattened, step back and hold
+            self.limit = max(self.limit - 1, 1)
+            self.last_action = None
+            self.hold_until = now + self.interval * 5
+            log(f'download {self.d.num}: speed flattened at {int(speed)} bytes/sec, connections:', self.limit,
+                '- average connection speed:', int(self.connection_speed), log_level=3)
+
+        elif self.limit < self.max_connections:
+            self.limit += 1
+            self.last_action = 'up'
+
+        self.prev_speed = speed
+        return self.limit
+
+
+class SegmentSizer:
+    """learn suitable segment size for a single download from finished transfers, segment should be big enough that
+    time to first byte is negligible, and small enough to be distributed over all connections"""
+
+    def __init__(self, d):
+        self.d = d
+        self.speed = 0  # average connection speed in bytes/sec
+        self.ttfb = 0  # average time to first byte in seconds
+
+    def __repr__(self):
+        return f'SegmentSizer(segment size: {self.segment_size})'
+
+    def report(self, worker):
+        """update averages from a finished worker transfer"""
+        if worker.error or not worker.speed or not worker.total_time:
+            return
+
+        if self.speed:
+            self.speed = 0.8 * self.speed + 0.2 * worker.speed
+            self.ttfb = 0.8 * self.ttfb + 0.2 * worker.ttfb
+        else:
+            self.speed, self.ttfb = worker.speed, worker.ttfb
+
+    @property
+    def segment_size(self):
+        """return suitable segment size in bytes, or 0 if no measurements yet"""
+        if not self.speed:
+            return 0
+
+        duration = max(self.ttfb * config.ttfb_ratio, config.min_segment_time)
+        size = int(self.speed * duration)
+
+        return min(max(size, config.min_segment_size), config.max_segment_size)
+
+
+class MirrorSelector:
+    """choose a source url for each new segment from a list of mirrors which serve the same file, number of connections
+    to each mirror is proportional to its measured speed per connection, mirrors keep failing will be dropped"""
+
+    def __init__(self, d, urls):
+        self.d = d
+        self.urls = list(urls)
+        self.speed = {url: 0 for url in self.urls}  # average connection speed in bytes/sec, 0 = not measured yet
+        self.active = {url: 0 for url in self.urls}  # number of running transfers
+        self.failures = {url: 0 for url in self.urls}  # consecutive failures
+
+    def __repr__(self):
+        return f'MirrorSelector(mirrors: {len(self.urls)})'
+
+    def select(self):
+        """return url for a new transfer"""
+        # try not measured mirrors first, then keep connections to each mirror proportional to its speed
+        known = [self.speed[url] for url in self.urls if self.speed[url]]
+        default_speed = sum(known) / len(known) if known else 1
+
+        def load(url):
+            return self.active[url] / (self.speed[url] or default_speed * 2)
+
+        url = min(self.urls, key=load)
+        self.active[url] += 1
+        return url
+
+    def report(self, worker):
+        """update mirror statistics from a finished worker transfer"""
+        url = worker.url
+        if url not in self.active:
+            return
+
+        self.active[url] = max(self.active[url] - 1, 0)
+
+        # segment might be completed even with an error i.e. transfer aborted after receiving all segment bytes
+        if (worker.error or worker.response_code >= 400) and not worker.seg.downloaded:
+            self.failures[url] += 1
+            if self.failures[url] >= config.mirror_max_failures and url in self.urls and len(self.urls) > 1:
+                self.urls.remove(url)
+                log(f'download {self.d.num}: drop mirror after {self.failures[url]} failures:', url, log_level=2)
+
+            return
+
+        self.failures[url] = 0
+
+        # ignore very short transfers, their speed is dominated by connection time
+        if worker.speed and worker.total_time >= 1:
+            if self.speed[url]:
+                self.speed[url] = 0.8 * self.speed[url] + 0.2 * worker.speed
+            else:
+                self.speed[url] = worker.speed
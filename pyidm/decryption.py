@@ -0,0 +1,135 @@
+"""
+    pyIDM
+
+    multi-connections internet download manager, based on "pyCuRL/curl", "youtube_dl", and "PySimpleGUI"
+
+    :copyright: (c) 2019-2020 by Mahmoud Elshahat.
+    :license: GNU LGPLv3, see LICENSE for more details.
+"""
+
+# decrypt AES-128 hls segments in a thread pool as soon as they are downloaded
+import os
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+from . import config
+from .config import Status
+from .utils import log, download, delete_file
+
+try:
+    from Crypto.Cipher import AES
+except:
+    AES = None
+    print('pycryptodome module is missing, encrypted hls videos will be decrypted by ffmpeg after download')
+
+
+def get_decrypted_file(name):
+    """return file name for decrypted data of a segment, downloaded segment file is kept unchanged, so its size
+    still matches segment size when resuming"""
+    return name + '.dec'
+
+
+def get_iv(text=None, sequence=0):
+    """return 16 bytes initialization vector from "IV=0x..." attribute value or from media sequence number"""
+    if text:
+        return int(text, 16).to_bytes(16, 'big')
+    return sequence.to_bytes(16, 'big')
+
+
+class Decryptor:
+    """fetch keys once per key uri and decrypt downloaded segments into separate files,
+    segments to be decrypted are listed in d.hls_keys, key: segment name, value: (key url, iv)"""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.executor = None
+        self.keys = {}  # key: key url, value: key bytes
+        self.key_locks = {}  # key: key url, value: Lock, to fetch every key once
+        self.pending = set()  # names of segments submitted for decryption
+
+    def __repr__(self):
+        return f'Decryptor(keys: {len(self.keys)}, pending: {len(self.pending)})'
+
+    @property
+    def available(self):
+        return AES is not None
+
+    def get_key(self, url):
+        with self.lock:
+            key_lock = self.key_locks.setdefault(url, Lock())
+
+        with key_lock:
+            key = self.keys.get(url)
+            if key is None:
+                buffer = download(url)
+                key = buffer.getvalue() if buffer else b''
+                if len(key) != 16:
+                    raise ValueError(f'invalid key, size: {len(key)} bytes, url: {url}')
+                self.keys[url] = key
+
+        return key
+
+    def submit(self, d, seg):
+        """decrypt a segment in background if it is downloaded and not decrypted yet, segments already merged are
+        skipped since their files might be deleted"""
+        if not seg or seg.name not in d.hls_keys or not seg.downloaded or seg.completed:
+            return
+
+        if seg.decrypted:
+            if os.path.isfile(get_decrypted_file(seg.name)):
+                return
+
+            # decrypted file is lost, decrypt again if downloaded file still exists
+            if not os.path.isfile(seg.name):
+                return
+            seg.decrypted = False
+
+        with self.lock:
+            if seg.name in self.pending:
+                return
+            self.pending.add(seg.name)
+
+            if not self.executor:
+                self.executor = ThreadPoolExecutor(max_workers=config.max_decrypt_workers,
+                                                   thread_name_prefix='decryptor')
+
+        self.executor.submit(self.decrypt, d, seg)
+
+    def decrypt(self, d, seg):
+        try:
+            key_url, iv = d.hls_keys[seg.name]
+            key = self.get_key(key_url)
+
+            with open(seg.name, 'rb') as f:
+                data = f.read()
+
+            data = AES.new(key, AES.MODE_CBC, iv).decrypt(data)
+
+            # remove PKCS7 padding
+            if data and 1 <= data[-1] <= 16:
+                data = data[:-data[-1]]
+
+            # write to a temp file first, a crash in the middle will not leave a half decrypted segment
+            decrypted_file = get_decrypted_file(seg.name)
+            with open(decrypted_file + '.tmp', 'wb') as f:
+                f.write(data)
+            os.replace(decrypted_file + '.tmp', decrypted_file)
+
+            seg.decrypted = True
+            seg.commit()
+
+            # wake up file manager
+            d.q.completed_jobs.put(seg.name)
+
+        except Exception as e:
+            log('Decryptor: failed to decrypt segment', os.path.basename(seg.name), '-', e)
+            delete_file(get_decrypted_file(seg.name) + '.tmp')
+            d.status = Status.error
+
+        finally:
+            with self.lock:
+                self.pending.discard(seg.name)
+
+
+# one decryption pool per process
+decryptor = Decryptor()
@@ -12,13 +12,16 @@
 import os
 import mimetypes
 import time
+import weakref
+from array import array
 from collections import deque
 from queue import Queue
-from threading import Thread, Lock
+from threading import Thread, Lock, Event
 from urllib.parse import urljoin
 from .utils import validate_file_name, get_headers, translate_server_code, size_splitter, get_seg_size, log, \
-    delete_file, delete_folder, save_json, load_json
+    delete_file, delete_folder, load_json, preallocate_file, calc_segment_size, probe_headers
 from . import config
+from .journal import ProgressJournal
 
 # lock used with downloaded property
 lock = Lock()
@@ -32,12 +35,12 @@ class Communication:
         # queues
         self.d_window = Queue()  # download window, required for log messages
         self.jobs = Queue()  # required for failed worker jobs
+        self.thread_mngr = Queue()  # workers post their tags when done, to wake up thread manager
+        self.completed_jobs = Queue()  # downloaded segments, to wake up file manager
 
         # self.worker = []
         # self.data = []
         # self.brain = Queue()  # brain queue
-        # self.thread_mngr = Queue()
-        # self.completed_jobs = Queue()
 
     @staticmethod
     def clear(q):
@@ -52,9 +55,9 @@ class Communication:
         """clear all queues"""
         self.clear(self.d_window)
         self.clear(self.jobs)
+        self.clear(self.thread_mngr)
+        self.clear(self.completed_jobs)
         # self.clear(self.brain)
-        # self.clear(self.thread_mngr)
-        # self.clear(self.completed_jobs)
 
         # for q in self.worker:
         #     self.clear(q)
@@ -78,31 +81,428 @@ class Communication:
         self.d_window.put(('log', s))
 
 
+# segment state flags stored in SegmentList.flags
+DOWNLOADED = 1
+COMPLETED = 2  # done downloading and merging into tempfile
+MERGE = 4  # segment file should be merged into tempfile
+SPARSE = 8  # segment will be written directly into tempfile at its range offset, no segment file, no merge
+LISTED = 16  # row is a part of segments list order, and included in counters
+DECRYPTED = 32  # encrypted hls segment has been decrypted in place
+
+
 class Segment:
-    def __init__(self, name=None, num=None, range=None, size=None, url=None, tempfile=None, seg_type='', merge=True):
-        self.num = num
-        self.size = size
-        self.range = range
-        self.downloaded = False
-        self.completed = False  # done downloading and merging into tempfile
-        self.name = name
-        self.tempfile = tempfile
-        self.headers = {}
-        self.url = url
-        self.seg_type = seg_type
-        self.merge = merge
+    """a lightweight view for a single segment stored in a SegmentList, a segment created directly will hold its data
+    in a private SegmentList until it is added to a download item segments"""
+
+    __slots__ = ('_table', '_row', '__weakref__')
+
+    def __init__(self, name=None, num=None, range=None, size=None, url=None, tempfile=None, seg_type='', merge=True,
+                 sparse=False, _table=None, _row=None):
+        if _table is None:
+            _table = SegmentList()
+            _row = _table.add(name=name, num=num, range=range, size=size, url=url, tempfile=tempfile,
+                              seg_type=seg_type, merge=merge, sparse=sparse)
+
+        self._table = _table
+        self._row = _row
+
+    # properties stored in table rows ----------------------------------------------------------------------------
+    @property
+    def num(self):
+        num = self._table.nums[self._row]
+        return num if num >= 0 else None
+
+    @property
+    def name(self):
+        return os.path.join(self._table.streams[self._table.stream_ids[self._row]][0], self._table.names[self._row])
+
+    @property
+    def tempfile(self):
+        return self._table.streams[self._table.stream_ids[self._row]][1]
+
+    @property
+    def seg_type(self):
+        return self._table.streams[self._table.stream_ids[self._row]][3]
+
+    @property
+    def url(self):
+        return self._table.urls.get(self._row) or self._table.streams[self._table.stream_ids[self._row]][2]
+
+    @url.setter
+    def url(self, value):
+        self._table.set_url(self._row, value)
+
+    @property
+    def start(self):
+        """first byte position of segment range, or -1 for segment without range"""
+        return self._table.starts[self._row]
+
+    @property
+    def end(self):
+        """last byte position of segment range, or -1 for segment without range"""
+        return self._table.ends[self._row]
+
+    @property
+    def range(self):
+        start = self._table.starts[self._row]
+        return f'{start}-{self._table.ends[self._row]}' if start >= 0 else None
+
+    @range.setter
+    def range(self, value):
+        self._table.set_range(self._row, value)
+
+    @property
+    def size(self):
+        return self._table.sizes[self._row]
+
+    @size.setter
+    def size(self, value):
+        self._table.set_size(self._row, value)
+
+    @property
+    def written(self):
+        """bytes already written into segment file, or into tempfile for sparse segment, for a completed segment it is
+        the number of bytes merged into tempfile"""
+        return self._table.written[self._row]
+
+    @written.setter
+    def written(self, value):
+        self._table.written[self._row] = value
+
+    @property
+    def downloaded(self):
+        return bool(self._table.flags[self._row] & DOWNLOADED)
+
+    @downloaded.setter
+    def downloaded(self, value):
+        self._table.set_flag(self._row, DOWNLOADED, value)
+
+    @property
+    def completed(self):
+        return bool(self._table.flags[self._row] & COMPLETED)
+
+    @completed.setter
+    def completed(self, value):
+        self._table.set_flag(self._row, COMPLETED, value)
+
+    @property
+    def merge(self):
+        return bool(self._table.flags[self._row] & MERGE)
+
+    @merge.setter
+    def merge(self, value):
+        self._table.set_flag(self._row, MERGE, value)
+
+    @property
+    def sparse(self):
+        return bool(self._table.flags[self._row] & SPARSE)
+
+    @sparse.setter
+    def sparse(self, value):
+        self._table.set_flag(self._row, SPARSE, value)
+
+    @property
+    def decrypted(self):
+        return bool(self._table.flags[self._row] & DECRYPTED)
+
+    @decrypted.setter
+    def decrypted(self, value):
+        self._table.set_flag(self._row, DECRYPTED, value)
+    # ------------------------------------------------------------------------------------------------------------
+
+    def commit(self):
+        """save segment progress to progress journal"""
+        self._table.commit(self._row)
+
+    @property
+    def started(self):
+        """True if segment has any downloaded data"""
+        return self.downloaded or self.written > 0
+
+    @property
+    def offset(self):
+        """segment start position in target file"""
+        return max(self.start, 0)
 
     def get_size(self):
-        self.headers = get_headers(self.url)
+        headers = probe_headers(self.url).result()
         try:
-            self.size = int(self.headers.get('content-length', 0))
+            self.size = int(headers.get('content-length', 0))
             print('Segment num:', self.num, 'getting size:', self.size)
         except:
             pass
         return self.size
 
+    def __eq__(self, other):
+        return isinstance(other, Segment) and other._table is self._table and other._row == self._row
+
+    def __hash__(self):
+        return hash((id(self._table), self._row))
+
+    def __repr__(self):
+        keys = ('num', 'name', 'range', 'size', 'url', 'tempfile', 'downloaded', 'completed', 'merge', 'sparse',
+                'written')
+        return repr({k: getattr(self, k) for k in keys})
+
+
+class SegmentList:
+    """compact table of segments, stores segments data in arrays instead of thousands of python objects,
+    Segment views are created on demand when indexing or iterating, it also keeps counters of segments states
+    updated, so progress and size info don't need to loop over all segments"""
+
+    def __init__(self, segments=()):
+        self.lock = Lock()
+
+        # rows, a row id is fixed for a segment, while its position in list is stored in self.order
+        self.starts = array('q')
+        self.ends = array('q')
+        self.sizes = array('q')
+        self.written = array('q')
+        self.nums = array('q')
+        self.stream_ids = array('H')
+        self.flags = bytearray()
+        self.names = []  # file base names, folder is stored once in stream info
+
+        # stream info will be shared by many segments, tuples of (folder, tempfile, url, seg_type)
+        self.streams = []
+        self._streams_map = {}  # key: (folder, tempfile, seg_type), value: index in self.streams
+
+        # url for rows which has different url than their stream, i.e. fragmented videos and hls segments
+        self.urls = {}
+
+        # row ids in list order
+        self.order = array('q')
+
+        # keep created segment views to return the same object for the same row while it is in use
+        self._views = weakref.WeakValueDictionary()
+
+        # counters
+        self.downloaded_count = 0
+        self.completed_count = 0
+        self.known_size = 0  # sum of segments sizes which are known
+        self.known_size_count = 0
+
+        # index of first not completed segment, i.e. next segment to be merged, all segments before it are completed
+        self.cursor = 0
+
+        # ProgressJournal object, rows changes will be written to it while it is opened
+        self.journal = None
+
+        self.extend(segments)
+
     def __repr__(self):
-        return repr(self.__dict__)
+        return f'SegmentList({len(self.order)} segments)'
+
+    # rows ----------------------------------------------------------------------------------------------------------
+    def add(self, name=None, num=None, range=None, size=None, url=None, tempfile=None, seg_type='', merge=True,
+            sparse=False, index=None):
+        """add a new segment and return its row id, segment will be inserted at index or appended if index is None"""
+        folder, base_name = os.path.split(name or '')
+
+        # stream info
+        key = (folder, tempfile, seg_type)
+        stream_id = self._streams_map.get(key)
+        if stream_id is None:
+            stream_id = len(self.streams)
+            self.streams.append((folder, tempfile, url, seg_type))
+            self._streams_map[key] = stream_id
+
+        with self.lock:
+            row = len(self.names)
+            self.names.append(base_name)
+            self.nums.append(num if num is not None else -1)
+            self.stream_ids.append(stream_id)
+            self.starts.append(-1)
+            self.ends.append(-1)
+            self.sizes.append(0)
+            self.written.append(0)
+            self.flags.append((MERGE if merge else 0) | (SPARSE if sparse else 0))
+
+        if url != self.streams[stream_id][2]:
+            self.urls[row] = url
+
+        self.set_range(row, range)
+        self.set_size(row, size)
+        self._list(row, index)
+
+        return row
+
+    def _sync(self, row):
+        """write row to progress journal, must be called while holding self.lock"""
+        if self.journal:
+            self.journal.update(self, row)
+
+    def commit(self, row):
+        """save row to progress journal, used for values which aren't saved automatically, i.e. written bytes"""
+        with self.lock:
+            self._sync(row)
+
+    def _list(self, row, index=None):
+        """put a row in list order and add its values to counters"""
+        with self.lock:
+            flag = self.flags[row]
+            self.flags[row] = flag | LISTED
+
+            self.downloaded_count += bool(flag & DOWNLOADED)
+            self.completed_count += bool(flag & COMPLETED)
+            if self.sizes[row]:
+                self.known_size += self.sizes[row]
+                self.known_size_count += 1
+
+            if index is None:
+                self.order.append(row)
+            else:
+                self.order.insert(index, row)
+                if index <= self.cursor:
+                    self.cursor = max(index, 0)
+
+            self._sync(row)
+
+    def _unlist(self, i):
+        """remove a row at index i from list order and subtract its values from counters"""
+        with self.lock:
+            row = self.order.pop(i)
+            flag = self.flags[row]
+            self.flags[row] = flag & ~LISTED
+
+            self.downloaded_count -= bool(flag & DOWNLOADED)
+            self.completed_count -= bool(flag & COMPLETED)
+            if self.sizes[row]:
+                self.known_size -= self.sizes[row]
+                self.known_size_count -= 1
+
+            if i < self.cursor:
+                self.cursor -= 1
+
+            self._sync(row)
+
+    def _adopt(self, seg, index=None):
+        """copy a segment from another table as a new row, and bind segment object to it"""
+        if seg._table is self and not self.flags[seg._row] & LISTED:
+            self._list(seg._row, index)
+            return
+
+        old_table, old_row = seg._table, seg._row
+        row = self.add(name=seg.name, num=seg.num, range=seg.range, size=seg.size, url=seg.url,
+                       tempfile=seg.tempfile, seg_type=seg.seg_type, merge=seg.merge, sparse=seg.sparse, index=index)
+        self.written[row] = seg.written
+        self.set_flag(row, DOWNLOADED, seg.downloaded)
+        self.set_flag(row, COMPLETED, seg.completed)
+        self.commit(row)
+
+        old_table._views.pop(old_row, None)
+        seg._table, seg._row = self, row
+        self._views[row] = seg
+
+    def set_flag(self, row, flag, value):
+        with self.lock:
+            old = self.flags[row]
+            new = old | flag if value else old & ~flag
+            if new == old:
+                return
+
+            self.flags[row] = new
+            self._sync(row)
+
+            if old & LISTED:
+                if flag == DOWNLOADED:
+                    self.downloaded_count += 1 if value else -1
+                elif flag == COMPLETED:
+                    self.completed_count += 1 if value else -1
+                    if not value:
+                        self.cursor = 0  # a segment reset, cursor will move forward again in next_to_merge()
+
+    def set_size(self, row, value):
+        value = value or 0
+        with self.lock:
+            old = self.sizes[row]
+            self.sizes[row] = value
+            self._sync(row)
+
+            if self.flags[row] & LISTED:
+                self.known_size += value - old
+                self.known_size_count += bool(value) - bool(old)
+
+    def set_range(self, row, value):
+        """set range from a string i.e. '0-1023' or None"""
+        if value:
+            start, end = [int(x) for x in value.split('-')]
+        else:
+            start = end = -1
+
+        with self.lock:
+            self.starts[row] = start
+            self.ends[row] = end
+            self._sync(row)
+
+    def set_url(self, row, value):
+        if value == self.streams[self.stream_ids[row]][2]:
+            self.urls.pop(row, None)
+        else:
+            self.urls[row] = value
+
+    def view(self, row):
+        """return Segment object for a row"""
+        seg = self._views.get(row)
+        if seg is None:
+            seg = Segment(_table=self, _row=row)
+            self._views[row] = seg
+        return seg
+
+    # list interface ------------------------------------------------------------------------------------------------
+    def __len__(self):
+        return len(self.order)
+
+    def __bool__(self):
+        return len(self.order) > 0
+
+    def __iter__(self):
+        for row in self.order:
+            yield self.view(row)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.view(row) for row in self.order[i]]
+        return self.view(self.order[i])
+
+    def index(self, seg):
+        if not isinstance(seg, Segment) or seg._table is not self:
+            raise ValueError(f'{seg} is not in list')
+        return self.order.index(seg._row)
+
+    def append(self, seg):
+        self._adopt(seg)
+
+    def extend(self, segments):
+        for seg in segments:
+            self._adopt(seg)
+
+    def __iadd__(self, segments):
+        self.extend(segments)
+        return self
+
+    def insert(self, i, seg):
+        self._adopt(seg, index=max(min(i, len(self.order)), 0))
+
+    def remove(self, seg):
+        self._unlist(self.index(seg))
+
+    # ---------------------------------------------------------------------------------------------------------------
+    def next_to_merge(self):
+        """return first not completed segment in list order or None if all segments completed"""
+        while self.cursor < len(self.order) and self.flags[self.order[self.cursor]] & COMPLETED:
+            self.cursor += 1
+
+        return self[self.cursor] if self.cursor < len(self.order) else None
+
+    def pending(self):
+        """return a list of not downloaded segments"""
+        return [self.view(row) for row in self.order[self.cursor:] if not self.flags[row] & DOWNLOADED]
+
+    @property
+    def average_size(self):
+        """average size of segments with known size"""
+        return self.known_size // self.known_size_count if self.known_size_count else 0
 
 
 class DownloadItem:
@@ -134,8 +534,15 @@ class DownloadItem:
         self._segment_size = config.segment_size
 
         self.live_connections = 0
-        self._downloaded = 0
+        self.priority = 1  # weight used by scheduler to share connections between running downloads
+        self.speed_limit = 0  # in bytes/sec for this download, zero == no limit
+        self._downloaded = 0  # downloaded bytes, excluding bytes counted by running workers
+
+        # running workers, each worker counts its own received bytes in "received" attribute without locking, they
+        # will be added to downloaded value when reading it
+        self.counters = []
         self._status = config.Status.cancelled
+        self.status_changed = Event()  # will be set whenever status changes, brain waits on it
         self.remaining_parts = 0
 
         self.q = Communication()  # queue
@@ -153,6 +560,17 @@ class DownloadItem:
         self.audio_size = 0
         self.is_audio = False
 
+        # hls segments will be joined into stream files while downloading, set by pre_process_hls()
+        self.hls_concat = False
+
+        # encrypted hls segments to be decrypted after download, key: segment name, value: (key url, iv)
+        self.hls_keys = {}
+
+        # other urls for the same file, segments will be downloaded from all of them
+        self.mirrors = []
+        self.valid_mirrors = []  # effective urls of mirrors which passed validate_mirrors()
+        self.etag = ''
+
         # postprocessing callback is a string represent any function name need to be called after done downloading
         # this function must be available or imported in brain.py namespace
         self.callback = ''
@@ -168,7 +586,7 @@ class DownloadItem:
         self.speed_refresh_rate = 1  # calculate speed every n time
 
         # segments
-        self._segments = []
+        self._segments = SegmentList()
 
         # fragmented video parameters will be updated from video subclass object / update_param()
         self.fragment_base_url = None
@@ -222,7 +640,8 @@ class DownloadItem:
                                  'remaining_parts', 'audio_url', 'audio_size', 'type', 'subtype_list', 'fragments',
                                  'fragment_base_url', 'audio_fragments', 'audio_fragment_base_url',
                                  'last_known_size', 'last_known_progress', 'protocol', 'manifest_url', 'width', 'height',
-                                 'abr', 'tbr', 'format_id', 'audio_format_id']
+                                 'abr', 'tbr', 'format_id', 'audio_format_id', 'priority', 'speed_limit', 'mirrors',
+                                 'etag']
 
     # def __getattr__(self, attrib):  # commented out as it makes problem with copy.copy module
     #     """this method will be called if no attribute found"""
@@ -235,74 +654,278 @@ class DownloadItem:
         for seg in self._segments:
             seg.downloaded = False
             seg.completed = False
+            seg.written = 0
 
     @property
     def segments(self):
         if not self._segments:
-            # handle fragmented video
-            if self.fragments:
-                # print(self.fragments)
+            self._segments = self.build_segments()
+
+        return self._segments
+
+    def build_segments(self, segment_size=None):
+        """return a new segments list, streams are split by segment_size if given, otherwise by segment size setting"""
+        # handle fragmented video
+        if self.fragments:
+            # print(self.fragments)
+            # example 'fragments': [{'path': 'range/0-640'}, {'path': 'range/2197-63702', 'duration': 9.985},]
+            segments = SegmentList()
+            for i, x in enumerate(self.fragments):
+                segments.add(name=os.path.join(self.temp_folder, str(i)), num=i, range=None, size=0,
+                             url=urljoin(self.fragment_base_url, x['path']), tempfile=self.temp_file)
+
+        else:
+            if self.resumable and self.size:
+                # get list of ranges i.e. ['0-100', 101-2000' ... ]
+                range_list = size_splitter(self.size, segment_size or self.segment_size)
+                sparse = config.sparse_file
+            else:
+                range_list = [None]  # add None in a list to make one segment with range=None
+                sparse = False
+
+            segments = SegmentList()
+            for i, x in enumerate(range_list):
+                segments.add(name=os.path.join(self.temp_folder, str(i)), num=i, range=x, size=get_seg_size(x),
+                             url=self.eff_url, tempfile=self.temp_file, merge=not sparse, sparse=sparse)
+
+        # get an audio stream to be merged with dash video
+        if 'dash' in self.subtype_list:
+            # handle fragmented audio
+            if self.audio_fragments:
                 # example 'fragments': [{'path': 'range/0-640'}, {'path': 'range/2197-63702', 'duration': 9.985},]
-                self._segments = [Segment(name=os.path.join(self.temp_folder, str(i)), num=i, range=None, size=0,
-                                          url=urljoin(self.fragment_base_url, x['path']), tempfile=self.temp_file)
-                                  for i, x in enumerate(self.fragments)]
+                for i, x in enumerate(self.audio_fragments):
+                    segments.add(name=os.path.join(self.temp_folder, str(i) + '_audio'), num=i, range=None,
+                                 size=0, url=urljoin(self.audio_fragment_base_url, x['path']),
+                                 tempfile=self.audio_file)
 
             else:
-                if self.resumable and self.size:
-                    # get list of ranges i.e. ['0-100', 101-2000' ... ]
-                    range_list = size_splitter(self.size, self.segment_size)
-                else:
-                    range_list = [None]  # add None in a list to make one segment with range=None
-
-                self._segments = [
-                    Segment(name=os.path.join(self.temp_folder, str(i)), num=i, range=x, size=get_seg_size(x),
-                            url=self.eff_url, tempfile=self.temp_file)
-                    for i, x in enumerate(range_list)]
-
-            # get an audio stream to be merged with dash video
-            if 'dash' in self.subtype_list:
-                # handle fragmented audio
-                if self.audio_fragments:
-                    # example 'fragments': [{'path': 'range/0-640'}, {'path': 'range/2197-63702', 'duration': 9.985},]
-                    audio_segments = [
-                        Segment(name=os.path.join(self.temp_folder, str(i) + '_audio'), num=i, range=None, size=0,
-                                url=urljoin(self.audio_fragment_base_url, x['path']), tempfile=self.audio_file)
-                        for i, x in enumerate(self.audio_fragments)]
-
-                else:
-                    range_list = size_splitter(self.audio_size, self.segment_size)
-
-                    audio_segments = [
-                        Segment(name=os.path.join(self.temp_folder, str(i) + '_audio'), num=i, range=x,
-                                size=get_seg_size(x), url=self.audio_url, tempfile=self.audio_file)
-                        for i, x in enumerate(range_list)]
-
-                # append to main list
-                self._segments += audio_segments
+                range_list = size_splitter(self.audio_size, segment_size or self.get_segment_size(self.audio_size))
+                sparse = config.sparse_file and self.audio_size > 0
 
-        return self._segments
+                for i, x in enumerate(range_list):
+                    segments.add(name=os.path.join(self.temp_folder, str(i) + '_audio'), num=i, range=x,
+                                 size=get_seg_size(x), url=self.audio_url, tempfile=self.audio_file,
+                                 merge=not sparse, sparse=sparse)
+
+        return segments
 
     @segments.setter
     def segments(self, value):
-        self._segments = value
+        self._segments = value if isinstance(value, SegmentList) else SegmentList(value)
+
+    @property
+    def journal_file(self):
+        return os.path.join(self.temp_folder, 'progress_info.bin')
+
+    def open_journal(self):
+        """start saving segments info to a progress journal on disk, segments changes will be saved instantly
+        return False if failed"""
+        self.save_progress_info()  # close previous journal if any
+
+        segments = self.segments
+        journal = ProgressJournal(self.journal_file)
+        try:
+            with segments.lock:
+                journal.create(segments, self.size)
+                segments.journal = journal
+            return True
+        except Exception as e:
+            log('open_journal()> failed to create progress journal:', e)
+            journal.close()
+            return False
 
     def save_progress_info(self):
-        """save segments info to disk"""
-        seg_list = [{'name': seg.name, 'downloaded':seg.downloaded, 'completed':seg.completed, 'size':seg.size} for seg in self.segments]
-        file = os.path.join(self.temp_folder, 'progress_info.txt')
-        save_json(file, seg_list)
+        """flush progress journal to disk and close it"""
+        segments = self._segments
+        with segments.lock:
+            journal, segments.journal = segments.journal, None
+
+        if journal:
+            journal.close()
+
+    def load_journal(self, records):
+        """rebuild segments list from progress journal records"""
+        segments = self.segments
+        current = {seg.name: seg for seg in segments}
+        new_list = SegmentList()
+
+        # sort listed rows by stream, then by segment number, split segments keep their parent number so they are
+        # sorted by range start, segments of the same stream might have different urls, i.e. hls byte range segments
+        records = [(row, *record) for row, record in enumerate(records) if record[7] & LISTED]
+        records.sort(key=lambda x: (x[7], x[2], x[3], x[0]))
+
+        for row, name, num, start, end, size, written, stream_id, flags in records:
+            folder, tempfile, url, seg_type = segments.streams[stream_id]
+
+            # a split segment "name@start" gets its url from its parent segment
+            seg = current.get(os.path.join(folder, name)) or current.get(os.path.join(folder, name.split('@')[0]))
+            name = os.path.join(folder, name)
+
+            new_row = new_list.add(name=name, num=num, range=f'{start}-{end}' if start >= 0 else None, size=size,
+                                   url=seg.url if seg else url, tempfile=tempfile, seg_type=seg_type,
+                                   merge=flags & MERGE, sparse=flags & SPARSE)
+            new_list.written[new_row] = written
+            new_list.set_flag(new_row, DOWNLOADED, flags & DOWNLOADED)
+            new_list.set_flag(new_row, COMPLETED, flags & COMPLETED)
+            new_list.set_flag(new_row, DECRYPTED, flags & DECRYPTED)
+
+        self._segments = new_list
 
     def load_progress_info(self):
         """load saved progress info from disk"""
+        records = ProgressJournal.load(self.journal_file, size=self.size)
+        if records and max(record[6] for record in records) < len(self.segments.streams):
+            self.load_journal(records)
+        else:
+            self.load_json_progress_info()
+
+        # get partially downloaded segment files sizes
+        self.scan_segments()
+
+    def load_json_progress_info(self):
+        """load progress info saved by older versions"""
         file = os.path.join(self.temp_folder, 'progress_info.txt')
         if os.path.isfile(file):
             seg_list = load_json(file)
-            for seg, item in zip(self.segments, seg_list):
+            if not seg_list:
+                return
+
+            # segment size used by older versions, before it gets changed by auto segment size
+            legacy_segment_size = self._segment_size or config.DEFAULT_SEGMENT_SIZE
+
+            # segments might have been split while downloading, rebuild segments list from saved ranges
+            if all('range' in item for item in seg_list) and seg_list[0]['name'] in [seg.name for seg in self.segments]:
+                segments = {seg.name: seg for seg in self.segments}
+                new_list = SegmentList()
+                template = None
+                for item in seg_list:
+                    seg = segments.get(item['name'])
+
+                    # a split segment, use previous segment in list as a template since it will be the same stream
+                    if seg:
+                        template = seg
+
+                    new_list.add(name=item['name'], num=template.num, range=item['range'], url=template.url,
+                                 tempfile=template.tempfile, seg_type=template.seg_type, merge=template.merge,
+                                 sparse=template.sparse)
+
+                self._segments = new_list
+                pairs = zip(new_list, seg_list)
+            else:
+                # ranges were not saved, build segments with the fixed segment size used before, segments built with
+                # auto segment size will have different ranges for the same names
+                self._segments = self.build_segments(segment_size=legacy_segment_size)
+                pairs = zip(self.segments, seg_list)
+
+            for seg, item in pairs:
                 if seg.name in item['name']:
                     seg.size = item['size']
                     seg.downloaded = item['downloaded']
                     seg.completed = item['completed']
 
+                    # keep the same writing mode used before, segment files or sparse temp file
+                    if seg.sparse != item.get('sparse', False):
+                        seg.sparse = not seg.sparse
+                        seg.merge = not seg.sparse
+                    seg.written = item.get('written', 0) if seg.sparse else 0
+
+            # no longer needed, progress journal will be used instead
+            delete_file(file)
+
+    def scan_segments(self):
+        """get sizes of existing segment files with a single scan of temp folder instead of checking segments files
+        one by one, then update segments written bytes and downloaded bytes counter"""
+        sizes = {}
+        try:
+            with os.scandir(self.temp_folder) as it:
+                for entry in it:
+                    if entry.is_file():
+                        sizes[entry.name] = entry.stat().st_size
+        except OSError:
+            pass
+
+        segments = self.segments
+        downloaded = 0
+        for row in segments.order:
+            # completed segment files might be deleted after merging, keep their saved merged bytes
+            if segments.flags[row] & (SPARSE | COMPLETED) == 0:
+                segments.written[row] = sizes.get(segments.names[row], 0)
+
+            if segments.flags[row] & DOWNLOADED:
+                downloaded += segments.sizes[row]
+            else:
+                downloaded += segments.written[row]
+
+        # restore downloaded bytes counter, it might be outdated if application didn't exit normally
+        self.downloaded = downloaded
+
+    def split_segment(self, seg, size):
+        """shrink a segment to the given size and create a new segment for the remaining range,
+        the new segment will be placed right after the original one to keep merging order
+        :param seg: Segment object with a range
+        :param size: new size of the original segment in bytes
+        :return: new Segment object or None if segment can't be split
+        """
+        if not seg.range or not 0 < size < seg.size:
+            return None
+
+        segments = self._segments
+        a, b = seg.start, seg.end
+        start = a + size
+
+        # name must be unique and the same after resuming, segment start position will be used, only base name is
+        # changed since folder name might contain "@"
+        folder, base_name = os.path.split(seg.name)
+        name = os.path.join(folder, f"{base_name.split('@')[0]}@{start}")
+
+        # shrink original segment, a running worker will stop writing when reaching new size
+        seg.range = f'{a}-{start - 1}'
+        seg.size = size
+
+        row = segments.add(name=name, num=seg.num, range=f'{start}-{b}', size=b - start + 1, url=seg.url,
+                           tempfile=seg.tempfile, seg_type=seg.seg_type, merge=seg.merge, sparse=seg.sparse,
+                           index=segments.index(seg) + 1)
+
+        return segments.view(row)
+
+    def join_segments(self, seg, next_seg):
+        """extend a segment range to include the range of the following segment and remove the later from list,
+        both segments must not be started and their ranges must be contiguous in the same file and url
+        return True if succeeded"""
+        if not (seg.range and next_seg.range) or seg.tempfile != next_seg.tempfile or seg.started or next_seg.started:
+            return False
+
+        if seg.url != next_seg.url:
+            return False
+
+        start, next_end = seg.start, next_seg.end
+        if next_seg.start != seg.end + 1:
+            return False
+
+        seg.range = f'{start}-{next_end}'
+        seg.size = next_end - start + 1
+        self._segments.remove(next_seg)
+
+        return True
+
+    def next_segment(self, seg):
+        """return the segment after a given segment in segments list or None"""
+        try:
+            return self._segments[self._segments.index(seg) + 1]
+        except (ValueError, IndexError):
+            return None
+
+    def preallocate(self):
+        """create temp files with full size for sparse segments to be written into, return False if failed"""
+        sizes = {self.temp_file: self.size, self.audio_file: self.audio_size}
+        files = {seg.tempfile for seg in self.segments if seg.sparse}
+
+        for file in files:
+            if not preallocate_file(file, sizes.get(file, 0)):
+                return False
+
+        return True
+
     @property
     def total_size(self):
         if 'dash' in self.subtype_list:
@@ -312,10 +935,7 @@ class DownloadItem:
 
         # estimate size based on size of downloaded fragments
         if not size and self._segments:
-            sizes = [seg.size for seg in self.segments if seg.size]
-            if sizes:
-                avg_seg_size = sum(sizes)//len(sizes)
-                size = avg_seg_size * len(self._segments)  # estimated
+            size = self._segments.average_size * len(self._segments)  # estimated
 
         if not size:
             return self.last_known_size
@@ -352,7 +972,8 @@ class DownloadItem:
 
     @property
     def downloaded(self):
-        return self._downloaded
+        counters = self.counters
+        return self._downloaded + sum(c.received for c in counters)
 
     @downloaded.setter
     def downloaded(self, value):
@@ -361,7 +982,18 @@ class DownloadItem:
             return
 
         with lock:
-            self._downloaded = value
+            self._downloaded = value - sum(c.received for c in self.counters)
+
+    def add_counters(self, counters):
+        """add workers' bytes counters to downloaded value"""
+        with lock:
+            self.counters = self.counters + list(counters)
+
+    def release_counters(self):
+        """move counted bytes of workers into downloaded value, called when workers are no longer used"""
+        with lock:
+            counters, self.counters = self.counters, []
+            self._downloaded += sum(c.received for c in counters)
 
     @property
     def progress(self):
@@ -369,8 +1001,8 @@ class DownloadItem:
             p = 100
         elif self.total_size == 0:
             # to handle fragmented files
-            finished = len([seg for seg in self.segments if seg.completed]) if self.segments else 0
-            p = round(finished * 100 / len(self.segments), 1)
+            segments = self.segments
+            p = round(segments.completed_count * 100 / len(segments), 1) if segments else 0
         else:
             p = round(self.downloaded * 100 / self.total_size, 1)
 
@@ -400,6 +1032,7 @@ class DownloadItem:
     @status.setter
     def status(self, value):
         self._status = value
+        self.status_changed.set()
 
     @property
     def num(self):
@@ -456,9 +1089,17 @@ class DownloadItem:
 
     @property
     def segment_size(self):
-        self._segment_size = config.segment_size
+        self._segment_size = self.get_segment_size(self.size)
         return self._segment_size
 
+    @staticmethod
+    def get_segment_size(size):
+        """return segment size for a stream with a given size, based on auto segment size setting"""
+        if config.auto_segment_size:
+            return calc_segment_size(size, config.max_connections)
+        else:
+            return config.segment_size
+
     @segment_size.setter
     def segment_size(self, value):
         self._segment_size = value if value <= self.size else self.size
@@ -477,7 +1118,9 @@ class DownloadItem:
             return
 
         self.url = url
-        headers = get_headers(url)
+
+        # same url might be requested by other threads i.e. while user typing url, will share the same request
+        headers = probe_headers(url).result()
         # print('update d parameters:', headers)
 
         # update headers only if no other update thread created with different url
@@ -528,6 +1171,29 @@ class DownloadItem:
             self.size = size
             self.type = content_type
             self.resumable = resumable
+            self.etag = headers.get('etag', '')
+
+    def validate_mirrors(self):
+        """check mirrors urls serve the same file, it must have same size, same etag if available, and support ranges
+        valid mirrors effective urls will be stored in self.valid_mirrors"""
+        self.valid_mirrors = []
+        if not self.resumable or not self.size or self.fragments:
+            return
+
+        for url in self.mirrors:
+            headers = get_headers(url)
+            size = int(headers.get('content-length', 0))
+            etag = headers.get('etag', '')
+            status_code = headers.get('status_code') or 0
+
+            if status_code >= 400 or size != self.size or headers.get('accept-ranges', 'none') == 'none':
+                log('mirror rejected:', url, '- status code:', status_code, 'size:', size)
+            elif self.etag and etag and etag != self.etag:
+                log('mirror rejected:', url, '- different etag:', etag)
+            elif headers.get('eff_url') and headers['eff_url'] not in self.valid_mirrors + [self.eff_url]:
+                self.valid_mirrors.append(headers['eff_url'])
+
+        log('valid mirrors:', len(self.valid_mirrors), 'of', len(self.mirrors))
         # print('done', url)
 
     def __repr__(self):
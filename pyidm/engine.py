@@ -0,0 +1,157 @@
+"""
+    pyIDM
+
+    multi-connections internet download manager, based on "pyCuRL/curl", "youtube_dl", and "PySimpleGUI"
+
+    :copyright: (c) 2019-2020 by Mahmoud Elshahat.
+    :license: GNU LGPLv3, see LICENSE for more details.
+"""
+
+# curl multi interface engine, run all segments transfers for all downloads in one thread
+import time
+import pycurl
+from queue import Queue, Empty
+from threading import Thread, Lock
+
+from . import config
+from .utils import log
+
+
+class CurlMultiEngine:
+    """drive workers' curl easy handles using a single curl multi handle and a single thread,
+    workers are added with add() and each worker's finish() method will be called when its transfer is done"""
+
+    def __init__(self):
+        self.m = pycurl.CurlMulti()
+        self.pending = Queue()  # workers waiting to be added to multi handle
+        self.handles = {}  # key: curl easy handle, value: worker
+        self.paused = {}  # key: curl easy handle, value: time to resume transfer, used for speed limit
+        self.thread = None
+        self.lock = Lock()
+
+    def __repr__(self):
+        return f'CurlMultiEngine(active handles: {len(self.handles)})'
+
+    def add(self, worker):
+        """add a worker to engine, worker.reuse() must be called before adding"""
+        worker.engine = self
+        self.pending.put(worker)
+        self.start()
+
+    def start(self):
+        """start engine thread if not running"""
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = Thread(target=self.run, daemon=True, name='curl_multi_engine')
+                self.thread.start()
+
+    def add_pending_workers(self):
+        for _ in range(self.pending.qsize()):
+            worker = self.pending.get()
+
+            # prepare() will return False if there is nothing to download
+            if worker.prepare():
+                self.m.add_handle(worker.c)
+                self.handles[worker.c] = worker
+            else:
+                worker.done()
+
+    def remove(self, c, error=None):
+        """remove curl handle from multi handle and report to its worker"""
+        self.m.remove_handle(c)
+        self.paused.pop(c, None)
+        worker = self.handles.pop(c, None)
+
+        if worker:
+            worker.finish(error=error)
+
+    def pause(self, worker, duration):
+        """mark worker's transfer as paused, must be called from worker's write callback which should return
+        pycurl.WRITEFUNC_PAUSE"""
+        self.paused[worker.c] = time.monotonic() + duration
+
+    def resume_paused(self):
+        """resume paused transfers when their time is up, return seconds until next transfer to resume or None"""
+        now = time.monotonic()
+        for c, resume_time in list(self.paused.items()):
+            if now >= resume_time:
+                del self.paused[c]  # removed before resuming, since write callback might pause it again
+                try:
+                    c.pause(pycurl.PAUSE_CONT)
+                except Exception as e:
+                    log('curl multi engine: failed to resume transfer', e, log_level=3)
+
+        return min(self.paused.values()) - now if self.paused else None
+
+    def read_info(self):
+        """check finished transfers"""
+        while True:
+            num_q, ok_list, err_list = self.m.info_read()
+
+            for c in ok_list:
+                self.remove(c)
+
+            for c, errno, errmsg in err_list:
+                self.remove(c, error=errmsg or f'curl error {errno}')
+
+            if num_q == 0:
+                break
+
+    def set_options(self):
+        """set multi handle options from current settings"""
+        options = [('M_MAX_HOST_CONNECTIONS', config.max_host_connections)]
+
+        # multiplex transfers to the same server as http2 streams over the same connection
+        if config.http2_multiplex:
+            options += [('M_PIPELINING', getattr(pycurl, 'PIPE_MULTIPLEX', 2)),
+                        ('M_MAX_CONCURRENT_STREAMS', config.max_streams)]
+
+        for name, value in options:
+            # some options are not available in old curl versions
+            try:
+                self.m.setopt(getattr(pycurl, name), value)
+            except Exception as e:
+                log('curl multi engine: option', name, 'not supported:', e, log_level=3)
+
+    def run(self):
+        log('curl multi engine: started', log_level=3)
+
+        self.set_options()
+
+        while not config.terminate:
+            self.add_pending_workers()
+
+            # sleep until a new worker get added, quit thread if idle for a while
+            if not self.handles:
+                try:
+                    worker = self.pending.get(timeout=5)
+                    self.pending.put(worker)
+                    continue
+                except Empty:
+                    with self.lock:
+                        if self.pending.empty():
+                            self.thread = None
+                            break
+                    continue
+
+            # run transfers
+            while True:
+                ret, num_handles = self.m.perform()
+                if ret != pycurl.E_CALL_MULTI_PERFORM:
+                    break
+
+            self.read_info()
+
+            # wait for network activity on any of the sockets, timeout in seconds
+            resume_after = self.resume_paused()
+            self.m.select(min(0.1, max(resume_after, 0.001)) if resume_after is not None else 0.1)
+
+        # abort remaining transfers on application exit
+        for c in list(self.handles):
+            self.remove(c, error='Callback aborted')
+
+        log('curl multi engine: quitting', log_level=3)
+
+
+# one engine per process
+engine = CurlMultiEngine()
@@ -322,9 +322,12 @@ class MainWindow:
 
             [sg.Text('Segment size:  '), sg.Input(default_text=size_format(config.segment_size), size=(10, 1),
                                                   enable_events=True, key='segment_size'),
-             sg.Text(f'Current value: {size_format(config.segment_size)}', size=(30, 1), key='seg_current_value'),
+             sg.Text(f'Current value: {self.segment_size_text}', size=(30, 1), key='seg_current_value'),
              sg.T('*ex: 512 KB or 5 MB', font='any 8')],
 
+            [sg.Checkbox('Auto segment size based on file size and download speed',
+                         default=config.auto_segment_size, enable_events=True, key='auto_segment_size')],
+
             [sg.Checkbox('process big playlist info on demand', default=config.process_big_playlist_on_demand,
                          enable_events=True, key='process_big_playlist_on_demand')],
 
@@ -859,6 +862,10 @@ class MainWindow:
             elif event == 'manually_select_dash_audio':
                 config.manually_select_dash_audio = values['manually_select_dash_audio']
 
+            elif event == 'auto_segment_size':
+                config.auto_segment_size = values['auto_segment_size']
+                self.window['seg_current_value'](f'current value: {self.segment_size_text}')
+
             elif event == 'segment_size':
                 user_input = values['segment_size']
 
@@ -876,9 +883,13 @@ class MainWindow:
                     seg_size = config.DEFAULT_SEGMENT_SIZE
 
                 config.segment_size = seg_size
-                self.window['seg_current_value'](f'current value: {size_format(config.segment_size)}')
                 self.d.segment_size = seg_size
 
+                # a fixed segment size entered by user overrides auto segment size
+                config.auto_segment_size = False
+                self.window['auto_segment_size'](False)
+                self.window['seg_current_value'](f'current value: {self.segment_size_text}')
+
             elif event == 'sett_folder':
                 selected = values['sett_folder']
                 if selected == 'Local':
@@ -1095,6 +1106,13 @@ class MainWindow:
     # endregion
 
     # region download
+    @property
+    def segment_size_text(self):
+        # segment size field is not used while auto segment size is enabled
+        if config.auto_segment_size:
+            return 'auto (segment size field is ignored)'
+        return size_format(config.segment_size)
+
     @property
     def active_downloads(self):
         # update active downloads
@@ -1190,7 +1208,7 @@ class MainWindow:
                 if d.size == d_from_list.size and d.selected_quality == d_from_list.selected_quality:
                     log('resume is possible')
                     # get the same segment size
-                    d.segment_size = d_from_list.segment_size
+                    d.segment_size = d_from_list._segment_size
                     d.downloaded = d_from_list.downloaded
                 else:
                     log('file:', d.name, 'has different properties and will be downloaded from beginning')
@@ -1440,6 +1458,9 @@ class MainWindow:
         d = self.selected_d
         config.download_folder = d.folder
 
+        # link might be expired, don't use cached headers
+        headers_cache.invalidate(d.url, d.eff_url)
+
         self.window['url'](d.url)
         self.url_text_change()
 
@@ -0,0 +1,111 @@
+"""
+    pyIDM
+
+    multi-connections internet download manager, based on "pyCuRL/curl", "youtube_dl", and "PySimpleGUI"
+
+    :copyright: (c) 2019-2020 by Mahmoud Elshahat.
+    :license: GNU LGPLv3, see LICENSE for more details.
+"""
+
+# binary progress journal, a memory mapped file with a fixed size record for every segment, records are updated in
+# place when segments state change, so progress survives a crash without rewriting the whole progress info
+import mmap
+import os
+import struct
+
+from .utils import log
+
+MAGIC = b'PYIDMPJ1'
+
+# magic, record size, records count, download size
+HEADER = struct.Struct('<8sIIq')
+
+# segment file base name, num, start, end, size, written, stream id, flags
+RECORD = struct.Struct('<64sqqqqqHB5x')
+
+
+class ProgressJournal:
+    """keep a SegmentList rows in a memory mapped file, record index is the row id in segments table"""
+
+    def __init__(self, file):
+        self.file = file
+        self.f = None
+        self.mm = None
+        self.capacity = 0  # number of records file can hold without resizing
+        self.count = 0
+
+    def __repr__(self):
+        return f'ProgressJournal({self.file}, records: {self.count})'
+
+    def create(self, segments, size=0):
+        """create a new journal file for a segments table, any previous journal will be overwritten
+        :param segments: SegmentList object
+        :param size: total download size, used to validate journal when loading
+        """
+        folder = os.path.dirname(self.file)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+
+        self.f = open(self.file, 'w+b')
+        self.count = len(segments.names)
+        self.resize(max(self.count * 2, 64))
+
+        HEADER.pack_into(self.mm, 0, MAGIC, RECORD.size, self.count, size or 0)
+        for row in range(self.count):
+            self.update(segments, row)
+
+    def resize(self, capacity):
+        """grow journal file to hold a given number of records"""
+        if self.mm:
+            self.mm.close()
+
+        self.f.truncate(HEADER.size + capacity * RECORD.size)
+        self.mm = mmap.mmap(self.f.fileno(), 0)
+        self.capacity = capacity
+
+    def update(self, segments, row):
+        """write a segment row into its record, new rows will extend the journal"""
+        if row >= self.count:
+            if row >= self.capacity:
+                self.resize(max(self.capacity * 2, row + 1))
+            self.count = row + 1
+            struct.pack_into('<I', self.mm, 12, self.count)
+
+        RECORD.pack_into(self.mm, HEADER.size + row * RECORD.size, segments.names[row].encode('utf-8'),
+                         segments.nums[row], segments.starts[row], segments.ends[row], segments.sizes[row],
+                         segments.written[row], segments.stream_ids[row], segments.flags[row])
+
+    def close(self):
+        try:
+            self.mm.flush()
+            self.mm.close()
+            self.f.close()
+        except Exception as e:
+            log('ProgressJournal.close()>', e, log_level=3)
+
+        self.mm = self.f = None
+
+    @staticmethod
+    def load(file, size=0):
+        """read records from a journal file, return a list of tuples
+        (name, num, start, end, size, written, stream id, flags) or None if file is missing or not valid
+        :param size: expected total download size, journal of a different size will be ignored
+        """
+        try:
+            with open(file, 'rb') as f:
+                buffer = f.read()
+
+            magic, record_size, count, journal_size = HEADER.unpack_from(buffer, 0)
+            if magic != MAGIC or record_size != RECORD.size or (size and journal_size != size):
+                return None
+
+            records = []
+            for offset in range(HEADER.size, HEADER.size + count * RECORD.size, RECORD.size):
+                name, *values = RECORD.unpack_from(buffer, offset)
+                records.append((name.rstrip(b'\x00').decode('utf-8'), *values))
+
+            return records
+
+        except Exception as e:
+            log('ProgressJournal.load()>', e, log_level=3)
+            return None
@@ -0,0 +1,147 @@
+"""
+    pyIDM
+
+    multi-connections internet download manager, based on "pyCuRL/curl", "youtube_dl", and "PySimpleGUI"
+
+    :copyright: (c) 2019-2020 by Mahmoud Elshahat.
+    :license: GNU LGPLv3, see LICENSE for more details.
+"""
+
+# bandwidth limiter, token buckets shared by all workers
+import time
+import weakref
+from threading import Lock
+
+from . import config
+from .utils import log
+
+
+class TokenBucket:
+    """tokens are bytes, added at "rate" bytes per second, consuming more than available tokens is allowed, and the
+    consumer should wait until the debt is paid back, rate=0 means no limit"""
+
+    burst_time = 0.25  # in seconds, max. tokens collected while idle = rate * burst_time
+
+    def __init__(self, rate=0):
+        self.lock = Lock()
+        self.rate = rate
+        self.tokens = 0
+        self.timestamp = time.monotonic()
+
+    def __repr__(self):
+        return f'TokenBucket(rate: {self.rate}, tokens: {int(self.tokens)})'
+
+    def set_rate(self, rate):
+        with self.lock:
+            if rate != self.rate:
+                self.refill()
+                self.rate = rate
+                self.tokens = min(self.tokens, rate * self.burst_time)
+
+    def refill(self):
+        """add tokens for time passed since last refill, must be called while holding self.lock"""
+        now = time.monotonic()
+        if self.rate:
+            self.tokens = min(self.tokens + (now - self.timestamp) * self.rate, self.rate * self.burst_time)
+        self.timestamp = now
+
+    def consume(self, n):
+        with self.lock:
+            self.refill()
+            if self.rate:
+                self.tokens -= n
+
+    def delay(self):
+        """return time in seconds to wait before consuming more tokens"""
+        with self.lock:
+            self.refill()
+            if self.rate and self.tokens < 0:
+                return -self.tokens / self.rate
+            return 0
+
+
+def parse_schedule_time(text):
+    """convert "HH:MM" to minutes since midnight"""
+    hours, minutes = text.split(':')
+    return int(hours) * 60 + int(minutes)
+
+
+def get_scheduled_limit(schedule, now=None):
+    """return speed limit of current time from a schedule or None if no entry matches
+    :param schedule: list of [start, end, limit], i.e. [['08:00', '17:30', 102400]], start, end are "HH:MM" local time,
+    if start > end the period extends over midnight.
+    """
+    now = now or time.localtime()
+    minute = now.tm_hour * 60 + now.tm_min
+
+    for start, end, limit in schedule:
+        try:
+            start, end = parse_schedule_time(start), parse_schedule_time(end)
+        except Exception as e:
+            log('speed limit schedule: invalid time:', start, end, e, log_level=3)
+            continue
+
+        if start <= minute < end or (start > end and (minute >= start or minute < end)):
+            return limit
+
+    return None
+
+
+class SpeedLimiter:
+    """limit download speed for all downloads "config.speed_limit" and for a single download "d.speed_limit",
+    bandwidth not used by some connections is available instantly for others since all connections share the same
+    bucket"""
+
+    # workers charge received bytes in batches to avoid taking buckets locks for every received chunk
+    batch_size = 64 * 1024
+
+    def __init__(self):
+        self.global_bucket = TokenBucket()
+        self.buckets = weakref.WeakKeyDictionary()  # key: download item, value: TokenBucket
+        self.update_time = 0
+
+    def __repr__(self):
+        return f'SpeedLimiter(global rate: {self.global_bucket.rate})'
+
+    @property
+    def global_limit(self):
+        limit = get_scheduled_limit(config.speed_limit_schedule)
+        return config.speed_limit if limit is None else limit
+
+    def update(self):
+        """apply current settings, checked once per second"""
+        now = time.monotonic()
+        if now - self.update_time >= 1:
+            self.update_time = now
+            self.global_bucket.set_rate(self.global_limit)
+
+    def get_buckets(self, d):
+        """return token buckets which apply to a download item, should be called periodically to apply settings
+        changes, it is called by thread manager loop"""
+        self.update()
+
+        bucket = self.buckets.get(d)
+        if bucket is None:
+            bucket = self.buckets.setdefault(d, TokenBucket())
+        if bucket.rate != d.speed_limit:
+            bucket.set_rate(d.speed_limit)
+
+        return self.global_bucket, bucket
+
+    @staticmethod
+    def consume(buckets, n):
+        """count received bytes, buckets without limit are skipped without locking"""
+        for bucket in buckets:
+            if bucket.rate:
+                bucket.consume(n)
+
+    @staticmethod
+    def delay(buckets):
+        """return time in seconds a download must wait before receiving more data
+        :param buckets: download item buckets returned by get_buckets()
+        """
+        return max(bucket.delay() if bucket.rate else 0 for bucket in buckets)
+
+
+# one limiter per process
+limiter = SpeedLimiter()
@@ -0,0 +1,335 @@
+"""
+    pyIDM
+
+    multi-connections internet download manager, based on "pyCuRL/curl", "youtube_dl", and "PySimpleGUI"
+
+    :copyright: (c) 2019-2020 by Mahmoud Elshahat.
+    :license: GNU LGPLv3, see LICENSE for more details.
+"""
+
+# m3u8 playlist parser, a single pass over playlist lines builds master playlist variants / renditions or media
+# playlist segments, reference: https://tools.ietf.org/html/rfc8216
+import hashlib
+import re
+from collections import OrderedDict
+from threading import Lock
+from urllib.parse import urljoin
+
+from . import config
+from .utils import log, download, probe_executor
+
+# attribute list, i.e. BANDWIDTH=1280000,RESOLUTION=1280x720,CODECS="avc1.4d401f,mp4a.40.2"
+ATTRIBUTE = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)')
+
+
+def parse_attributes(text):
+    """convert attribute list to a dict, quotes are removed from quoted string values"""
+    return {name: value[1:-1] if value.startswith('"') else value for name, value in ATTRIBUTE.findall(text)}
+
+
+def get_url_joiner(base_url):
+    """return a function which converts a relative uri to absolute url, same as urljoin() but much faster for simple
+    relative uris i.e. "segment1.ts", which is the case for most media segments"""
+    base = base_url.split('#')[0].split('?')[0]
+    folder = base[:base.rfind('/') + 1] if base.count('/') >= 3 else None
+
+    def join(uri):
+        if '://' in uri:
+            return uri
+        if folder is None or uri[0] in '/.?#' or ':' in uri:
+            return urljoin(base_url, uri)
+        return folder + uri
+
+    return join
+
+
+def parse_byterange(text, offset=0):
+    """convert "length[@offset]" to (length, offset), if offset is missing it is the given offset,
+    i.e. end of previous sub-range of the same resource"""
+    length, _, start = text.partition('@')
+    return int(length), int(start) if start else offset
+
+
+class Key:
+    """#EXT-X-KEY, method NONE means following segments are not encrypted"""
+
+    __slots__ = ('method', 'uri', 'url', 'iv', 'keyformat', 'line')
+
+    def __init__(self, attributes, base_url='', line=0):
+        self.method = attributes.get('METHOD', 'NONE')
+        self.uri = attributes.get('URI')
+        self.url = urljoin(base_url, self.uri) if self.uri else None
+        self.iv = attributes.get('IV')  # hexadecimal text i.e. 0x0000..., None if not specified
+        self.keyformat = attributes.get('KEYFORMAT', 'identity')
+        self.line = line
+
+    def __repr__(self):
+        return f'Key({self.method}, {self.uri})'
+
+
+class InitSection:
+    """#EXT-X-MAP, initialization section of fMP4 segments"""
+
+    __slots__ = ('uri', 'url', 'byterange', 'key', 'sequence', 'line')
+
+    def __init__(self, attributes, base_url='', key=None, sequence=0, line=0):
+        self.uri = attributes.get('URI')
+        self.url = urljoin(base_url, self.uri)
+        self.byterange = parse_byterange(attributes['BYTERANGE']) if 'BYTERANGE' in attributes else None
+        self.key = key
+        self.sequence = sequence
+        self.line = line
+
+    def __repr__(self):
+        return f'InitSection({self.uri})'
+
+
+class MediaSegment:
+    __slots__ = ('uri', 'url', 'duration', 'title', 'byterange', 'key', 'init_section', 'discontinuity',
+                 'sequence', 'line', 'byterange_line')
+
+    def __init__(self, uri, url, duration=0, title='', byterange=None, key=None, init_section=None,
+                 discontinuity=False, sequence=0, line=0, byterange_line=None):
+        self.uri = uri
+        self.url = url
+        self.duration = duration
+        self.title = title
+        self.byterange = byterange  # (length, offset) or None
+        self.key = key  # Key object or None if not encrypted
+        self.init_section = init_section
+        self.discontinuity = discontinuity
+        self.sequence = sequence  # media sequence number
+        self.line = line  # line index in playlist
+        self.byterange_line = byterange_line  # line index of "#EXT-X-BYTERANGE" tag
+
+    def __repr__(self):
+        return f'MediaSegment({self.sequence}, {self.uri})'
+
+
+class Variant:
+    """#EXT-X-STREAM-INF in a master playlist"""
+
+    __slots__ = ('uri', 'url', 'attributes', 'bandwidth', 'resolution', 'codecs', 'audio', 'line')
+
+    def __init__(self, uri, url, attributes, line=0):
+        self.uri = uri
+        self.url = url
+        self.attributes = attributes
+        self.bandwidth = int(attributes.get('BANDWIDTH') or 0)
+        self.codecs = attributes.get('CODECS', '')
+        self.audio = attributes.get('AUDIO')  # group id of audio renditions
+        self.line = line
+
+        try:
+            width, height = attributes['RESOLUTION'].lower().split('x')
+            self.resolution = (int(width), int(height))
+        except (KeyError, ValueError):
+            self.resolution = None
+
+    def __repr__(self):
+        return f'Variant({self.bandwidth}, {self.resolution}, {self.uri})'
+
+
+class Rendition:
+    """#EXT-X-MEDIA in a master playlist"""
+
+    __slots__ = ('type', 'group_id', 'name', 'language', 'uri', 'url', 'attributes', 'line')
+
+    def __init__(self, attributes, base_url='', line=0):
+        self.type = attributes.get('TYPE')
+        self.group_id = attributes.get('GROUP-ID')
+        self.name = attributes.get('NAME')
+        self.language = attributes.get('LANGUAGE')
+        self.uri = attributes.get('URI')
+        self.url = urljoin(base_url, self.uri) if self.uri else None
+        self.attributes = attributes
+        self.line = line
+
+    def __repr__(self):
+        return f'Rendition({self.type}, {self.group_id}, {self.name})'
+
+
+class Playlist:
+    def __init__(self, url='', text=''):
+        self.url = url
+        self.text = text
+        self.lines = text.splitlines()
+        self.is_master = False
+        self.version = 1
+        self.target_duration = 0
+        self.media_sequence = 0
+        self.endlist = False
+
+        # master playlist
+        self.variants = []
+        self.renditions = []
+
+        # media playlist
+        self.segments = []
+        self.keys = []
+        self.init_sections = []
+
+    def __repr__(self):
+        if self.is_master:
+            return f'Playlist(master, variants: {len(self.variants)}, renditions: {len(self.renditions)})'
+        return f'Playlist(media, segments: {len(self.segments)})'
+
+    @property
+    def duration(self):
+        return sum(seg.duration for seg in self.segments)
+
+
+def parse(text, url=''):
+    """parse m3u8 playlist text, return Playlist object or None if text is not a m3u8 playlist
+    :param url: playlist url, used to get absolute urls from relative uris
+    """
+    if not text or '#EXT' not in text:
+        return None
+
+    playlist = Playlist(url, text)
+    join = get_url_joiner(url)
+
+    # state for next media segment
+    duration, title, byterange, byterange_line, discontinuity, stream_inf = 0, '', None, None, False, None
+    key = init_section = None
+    sequence = 0
+    offsets = {}  # key: uri, value: end of last byte range, used when next range of same uri has no offset
+
+    for i, line in enumerate(playlist.lines):
+        line = line.strip()
+        if not line:
+            continue
+
+        # media or variant uri
+        if not line.startswith('#'):
+            if stream_inf is not None:
+                playlist.variants.append(Variant(line, join(line), stream_inf, line=i))
+                stream_inf = None
+                continue
+
+            if byterange:
+                byterange = parse_byterange(byterange, offsets.get(line, 0))
+                offsets[line] = byterange[0] + byterange[1]
+
+            playlist.segments.append(MediaSegment(line, join(line), duration=duration, title=title,
+                                                  byterange=byterange, key=key, init_section=init_section,
+                                                  discontinuity=discontinuity, sequence=sequence, line=i,
+                                                  byterange_line=byterange_line))
+            sequence += 1
+            duration, title, byterange, byterange_line, discontinuity = 0, '', None, None, False
+            continue
+
+        tag, _, value = line.partition(':')
+
+        if tag == '#EXTINF':
+            duration, _, title = value.partition(',')
+            try:
+                duration = float(duration)
+            except ValueError:
+                duration = 0
+
+        elif tag == '#EXT-X-BYTERANGE':
+            byterange, byterange_line = value, i
+
+        elif tag == '#EXT-X-KEY':
+            key = Key(parse_attributes(value), url, line=i)
+            playlist.keys.append(key)
+            if key.method == 'NONE':
+                key = None
+
+        elif tag == '#EXT-X-MAP':
+            init_section = InitSection(parse_attributes(value), url, key=key, sequence=sequence, line=i)
+            playlist.init_sections.append(init_section)
+
+        elif tag == '#EXT-X-DISCONTINUITY':
+            discontinuity = True
+
+        elif tag == '#EXT-X-MEDIA-SEQUENCE':
+            sequence = playlist.media_sequence = int(value)
+
+        elif tag == '#EXT-X-TARGETDURATION':
+            playlist.target_duration = int(value)
+
+        elif tag == '#EXT-X-VERSION':
+            playlist.version = int(value)
+
+        elif tag == '#EXT-X-ENDLIST':
+            playlist.endlist = True
+
+        elif tag == '#EXT-X-STREAM-INF':
+            playlist.is_master = True
+            stream_inf = parse_attributes(value)
+
+        elif tag == '#EXT-X-MEDIA':
+            playlist.is_master = True
+            playlist.renditions.append(Rendition(parse_attributes(value), url, line=i))
+
+    return playlist
+
+
+class PlaylistCache:
+    """parsed playlists, key: url, value: (validator, playlist), validator is server ETag or a hash of playlist text,
+    a playlist downloaded again i.e. when resuming, will not be parsed again if not changed"""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.entries = OrderedDict()
+
+    def __repr__(self):
+        return f'PlaylistCache(entries: {len(self.entries)})'
+
+    def get(self, url, validator):
+        with self.lock:
+            entry = self.entries.get(url)
+            if entry and entry[0] == validator:
+                self.entries.move_to_end(url)
+                return entry[1]
+            return None
+
+    def put(self, url, validator, playlist):
+        with self.lock:
+            self.entries[url] = (validator, playlist)
+            self.entries.move_to_end(url)
+
+            while len(self.entries) > config.m3u8_cache_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+playlist_cache = PlaylistCache()
+
+
+def get_playlist(url):
+    """download and parse m3u8 playlist, return Playlist object or None"""
+    headers = {}
+    buffer = download(url, headers=headers)
+    if not buffer:
+        return None
+
+    data = buffer.getvalue()
+    validator = headers.get('etag') or hashlib.md5(data).hexdigest()
+
+    playlist = playlist_cache.get(url, validator)
+    if playlist:
+        log('get_playlist()> playlist not changed, use cached:', url, log_level=3)
+        return playlist
+
+    try:
+        playlist = parse(data.decode(), url)
+    except Exception as e:
+        log('get_playlist()> failed to parse playlist:', url, e)
+        return None
+
+    if playlist:
+        playlist_cache.put(url, validator, playlist)
+
+    return playlist
+
+
+def fetch_playlist(url):
+    """download and parse playlist in background, return a concurrent.futures.Future object, its result() is a
+    Playlist object or None, it shares the header probes thread pool, and connections through curl_pool"""
+    return probe_executor.submit(get_playlist, url)
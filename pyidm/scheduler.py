@@ -0,0 +1,104 @@
+"""
+    pyIDM
+
+    multi-connections internet download manager, based on "pyCuRL/curl", "youtube_dl", and "PySimpleGUI"
+
+    :copyright: (c) 2019-2020 by Mahmoud Elshahat.
+    :license: GNU LGPLv3, see LICENSE for more details.
+"""
+
+# process wide scheduler, share a global connections budget between running downloads
+import heapq
+from threading import Lock
+from urllib.parse import urlparse
+
+from . import config
+from .utils import log
+
+
+class DownloadScheduler:
+    """allocate connections for running downloads from a global budget, each download thread manager reports how many
+    connections it can use "demand" and gets its share "allowance",
+    budget is distributed by priority weighted fair share, with a limit per server, connections not needed by a
+    download i.e. nearly finished download, go to other downloads"""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.downloads = {}  # key: download item, value: demand
+        self.allocation = {}  # key: download item, value: allowed connections
+
+    def __repr__(self):
+        return f'DownloadScheduler(downloads: {len(self.downloads)}, budget: {self.budget})'
+
+    @property
+    def budget(self):
+        """total connections for all downloads"""
+        return config.total_connections or config.max_connections * config.max_concurrent_downloads
+
+    @staticmethod
+    def get_host(d):
+        try:
+            return urlparse(d.eff_url or d.url).netloc
+        except:
+            return ''
+
+    def register(self, d, demand=0):
+        with self.lock:
+            self.downloads[d] = demand
+            self.allocate()
+
+    def unregister(self, d):
+        with self.lock:
+            self.downloads.pop(d, None)
+            self.allocation.pop(d, None)
+            self.allocate()
+
+    def allowance(self, d, demand):
+        """update demand of a download and return number of connections it is allowed to use"""
+        with self.lock:
+            if self.downloads.get(d) != demand:
+                self.downloads[d] = demand
+                self.allocate()
+
+            return self.allocation.get(d, 0)
+
+    def allocate(self):
+        """distribute budget one connection at a time, to the download with lowest allocated / priority ratio,
+        must be called while holding self.lock"""
+        allocation = {d: 0 for d in self.downloads}
+        hosts = {}  # key: host, value: allocated connections
+        host_limit = config.max_host_connections
+
+        # heap items: (ratio, order, download)
+        heap = [(0, i, d) for i, d in enumerate(self.downloads) if self.downloads[d] > 0]
+        heapq.heapify(heap)
+
+        budget = self.budget
+        while budget and heap:
+            _, i, d = heapq.heappop(heap)
+            host = self.get_host(d)
+
+            # download reached its server limit, skip it
+            if host_limit and hosts.get(host, 0) >= host_limit:
+                continue
+
+            allocation[d] += 1
+            hosts[host] = hosts.get(host, 0) + 1
+            budget -= 1
+
+            if allocation[d] < self.downloads[d]:
+                heapq.heappush(heap, (allocation[d] / max(d.priority, 1), i, d))
+
+        # wake up thread managers of downloads which got more connections
+        for d, n in allocation.items():
+            if n > self.allocation.get(d, 0):
+                d.q.thread_mngr.put('scheduler')
+
+        if allocation != self.allocation:
+            log('scheduler: connections allocation:', {d.num: n for d, n in allocation.items()}, log_level=3)
+
+        self.allocation = allocation
+
+
+# one scheduler per process
+scheduler = DownloadScheduler()
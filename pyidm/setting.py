@@ -167,6 +167,10 @@ def load_setting():
         # update config module
         config.__dict__.update(settings)
 
+        # settings saved by older versions, a segment size chosen by user will keep working as a fixed segment size
+        if 'auto_segment_size' not in settings and 'segment_size' in settings:
+            config.auto_segment_size = settings['segment_size'] == config.DEFAULT_SEGMENT_SIZE
+
 
 def save_setting():
     settings = {key: config.__dict__.get(key) for key in config.settings_keys}
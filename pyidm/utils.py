@@ -20,6 +20,10 @@ import shlex
 import re
 import json
 import pyperclip as clipboard
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from urllib.parse import urlparse
 try:
     from PIL import Image
 except:
@@ -97,8 +101,132 @@ def set_curl_options(c):
     c.setopt(pycurl.AUTOREFERER, 1)
 
 
-def get_headers(url, verbose=False):
-    """return dictionary of headers"""
+class CurlPool:
+    """process wide pool of reusable curl handles, all handles share DNS cache, TLS sessions, and connections cache,
+    so new requests to the same server will skip DNS lookup, TCP connection, and TLS handshake,
+    idle handles are kept per server, key is "scheme://host:port" """
+
+    def __init__(self, size=None):
+        self.size = size  # max. idle handles per server, None means use config.curl_pool_size
+        self.lock = Lock()
+        self.idle = {}  # key: server, value: list of idle curl handles
+
+        self.share = pycurl.CurlShare()
+        for data in ('LOCK_DATA_DNS', 'LOCK_DATA_SSL_SESSION', 'LOCK_DATA_CONNECT'):
+            # connection cache sharing is not available in old curl versions
+            try:
+                self.share.setopt(pycurl.SH_SHARE, getattr(pycurl, data))
+            except Exception as e:
+                log('CurlPool()> sharing', data, 'not supported:', e, log_level=3)
+
+    def __repr__(self):
+        return f'CurlPool(idle handles: {sum(len(x) for x in self.idle.values())})'
+
+    @staticmethod
+    def get_key(url):
+        try:
+            url = urlparse(url)
+            return f'{url.scheme}://{url.netloc}'
+        except:
+            return ''
+
+    def get(self, url=''):
+        """return a curl handle, previously used for the same server if available"""
+        with self.lock:
+            handles = self.idle.get(self.get_key(url))
+            c = handles.pop() if handles else None
+
+        if not c:
+            c = pycurl.Curl()
+
+        c.setopt(pycurl.SHARE, self.share)
+        return c
+
+    def put(self, c, url=''):
+        """return a curl handle to pool, it mustn't be used by caller anymore"""
+        key = self.get_key(url)
+        size = self.size or config.curl_pool_size
+
+        # reset options and release callbacks, it will keep connections, DNS, and TLS sessions caches
+        c.reset()
+
+        with self.lock:
+            handles = self.idle.setdefault(key, [])
+            if len(handles) < size:
+                handles.append(c)
+                return
+
+        c.close()
+
+
+# one pool per process
+curl_pool = CurlPool()
+
+
+class HeadersCache:
+    """thread safe LRU cache for get_headers() results with time to live for each entry,
+    failed requests are cached for a shorter time to avoid hammering a dead link"""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.entries = OrderedDict()  # key: url, value: (expiry time, headers)
+
+    def __repr__(self):
+        return f'HeadersCache(entries: {len(self.entries)})'
+
+    def get(self, url):
+        """return a copy of cached headers or None"""
+        with self.lock:
+            entry = self.entries.get(url)
+            if not entry:
+                return None
+
+            expiry, headers = entry
+            if time.monotonic() >= expiry:
+                del self.entries[url]
+                return None
+
+            self.entries.move_to_end(url)
+            return dict(headers)
+
+    def put(self, url, headers):
+        status_code = headers.get('status_code') or 0
+        failed = not status_code or status_code >= 400
+        ttl = config.headers_cache_negative_ttl if failed else config.headers_cache_ttl
+
+        if not ttl:
+            return
+
+        with self.lock:
+            self.entries[url] = (time.monotonic() + ttl, dict(headers))
+            self.entries.move_to_end(url)
+
+            while len(self.entries) > config.headers_cache_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, *urls):
+        """remove urls from cache, i.e. when refreshing an expired link"""
+        with self.lock:
+            for url in urls:
+                self.entries.pop(url, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+headers_cache = HeadersCache()
+
+
+def get_headers(url, verbose=False, use_cache=True):
+    """return dictionary of headers
+    :param use_cache: return cached headers of the same url if not expired
+    """
+
+    if use_cache:
+        headers = headers_cache.get(url)
+        if headers is not None:
+            return headers
 
     # log('get_headers()> getting headers for:', url)
 
@@ -134,7 +262,7 @@ def get_headers(url, verbose=False):
         return 0
 
     # region curl options
-    c = pycurl.Curl()
+    c = curl_pool.get(url)
 
     # set general curl options
     set_curl_options(c)
@@ -155,14 +283,47 @@ def get_headers(url, verbose=False):
     curl_headers['status_code'] = c.getinfo(pycurl.RESPONSE_CODE)
     curl_headers['eff_url'] = c.getinfo(pycurl.EFFECTIVE_URL)
 
+    curl_pool.put(c, url)
+
+    headers_cache.put(url, curl_headers)
+
     # return headers
     return curl_headers
 
 
-def download(url, file_name=None):
+# bounded thread pool to fetch headers of many urls concurrently, i.e. streams of a video or videos of a playlist
+probe_executor = ThreadPoolExecutor(max_workers=config.max_header_probes, thread_name_prefix='probe_headers')
+probes = {}  # in-flight probes, key: url, value: Future object
+probes_lock = Lock()
+
+
+def probe_headers(url):
+    """fetch headers in background, return a concurrent.futures.Future object, its result() is headers dictionary
+    the same Future will be returned if the same url requested again while the previous request still in progress"""
+    with probes_lock:
+        future = probes.get(url)
+        if future:
+            return future
+
+        future = probe_executor.submit(get_headers, url)
+        probes[url] = future
+
+    def remove_probe(f):
+        with probes_lock:
+            if probes.get(url) is f:
+                del probes[url]
+
+    # done callback might be called immediately, it must not be called while holding the lock
+    future.add_done_callback(remove_probe)
+
+    return future
+
+
+def download(url, file_name=None, headers=None):
     """simple file download, return False if failed,
     :param url: text url link
     :param file_name: if specified it will save file to disk, otherwise it will buffer to memory
+    :param headers: optional dict, will be filled with response headers, names are in lower case
     it will return True / buffer or False"""
 
     if not url:
@@ -178,11 +339,20 @@ def download(url, file_name=None):
         # set special curl options
         c.setopt(pycurl.URL, url)
 
+        if headers is not None:
+            c.setopt(pycurl.HEADERFUNCTION, header_callback)
+
+    def header_callback(header_line):
+        header_line = header_line.decode('iso-8859-1')
+        if ':' in header_line:
+            name, value = header_line.split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+
     file = None
     buffer = None
 
     # pycurl
-    c = pycurl.Curl()
+    c = curl_pool.get(url)
     set_options()
 
     if file_name:
@@ -199,7 +369,7 @@ def download(url, file_name=None):
         log('download():', e)
         return False
     finally:
-        c.close()
+        curl_pool.put(c, url)
         if file:
             file.close()
 
@@ -342,6 +512,21 @@ def size_splitter(size, part_size):
     return result
 
 
+def calc_segment_size(size, connections):
+    """calculate suitable segment size for a file, few big segments for big files and small segments for
+    small files to make use of all connections, result is limited by config.min_segment_size and max_segment_size"""
+    if not size:
+        return config.segment_size
+
+    seg_size = size // max(connections * config.segments_per_connection, 1)
+
+    # round up to a multiple of 64 KB
+    block = 64 * 1024
+    seg_size = (seg_size // block + 1) * block
+
+    return min(max(seg_size, config.min_segment_size), config.max_segment_size)
+
+
 def delete_folder(folder, verbose=False):
     try:
         shutil.rmtree(folder)
@@ -390,6 +575,76 @@ def get_seg_size(seg):
         return 0
 
 
+def append_file(src, trgt_file, buffer_size=1024 * 1024):
+    """append a file content to an opened target file object without loading the whole file into memory,
+    it will use zero-copy os.copy_file_range() or os.sendfile() if available, otherwise it will copy in chunks
+    :param src: source file name
+    :param trgt_file: target file object opened in binary write mode, data will be written at current position
+    :param buffer_size: chunk size in bytes used in fallback copying
+    """
+    trgt_file.flush()
+
+    with open(src, 'rb') as src_file:
+        size = os.fstat(src_file.fileno()).st_size
+        copied = 0
+
+        # zero-copy, data doesn't need to pass through python, available on linux
+        for func in (getattr(os, 'copy_file_range', None), getattr(os, 'sendfile', None)):
+            if func is None or not size:
+                continue
+
+            try:
+                trgt_fd, src_fd = trgt_file.fileno(), src_file.fileno()
+                while copied < size:
+                    if func is os.sendfile:
+                        n = func(trgt_fd, src_fd, copied, size - copied)
+                    else:
+                        n = func(src_fd, trgt_fd, size - copied)
+
+                    if not n:
+                        break
+                    copied += n
+
+                if copied == size:
+                    # update file object position
+                    trgt_file.seek(0, os.SEEK_END)
+                    return
+            except OSError:
+                pass
+
+            # fall back to next method starting from the last copied position
+            src_file.seek(copied)
+            trgt_file.seek(0, os.SEEK_END)
+
+        shutil.copyfileobj(src_file, trgt_file, buffer_size)
+
+
+def preallocate_file(file, size):
+    """create a file with the given size or resize an existing one, disk space will be reserved if supported by
+    operating system, otherwise a sparse file will be created
+    return True if succeeded"""
+    try:
+        # keep existing file if it has the correct size, i.e. resuming a previous download
+        if os.path.isfile(file) and os.path.getsize(file) == size:
+            return True
+
+        mode = 'r+b' if os.path.isfile(file) else 'wb'
+        with open(file, mode) as f:
+            f.truncate(size)
+
+            # reserve disk space, available on linux
+            if hasattr(os, 'posix_fallocate') and size:
+                try:
+                    os.posix_fallocate(f.fileno(), 0, size)
+                except OSError:
+                    pass
+
+        return True
+    except Exception as e:
+        log('preallocate_file()> ', e)
+        return False
+
+
 def run_command(cmd, verbose=True, shell=False, hide_window=False, d=None):
     """run command in as a subprocess
     :param d, DownloadItem reference, if exist will monitor user cancel action for terminating process
@@ -775,6 +1030,7 @@ __all__ = [
     'run_command', 'print_object', 'update_object', 'truncate', 'sort_dictionary', 'popup', 'compare_versions',
     'translate_server_code', 'validate_url', 'open_file', 'clipboard_read', 'clipboard_write', 'delete_file',
     'rename_file', 'load_json', 'save_json', 'echo_stdout', 'echo_stderr', 'log_recorder', 'natural_sort',
-    'process_thumbnail', 'parse_bytes', 'set_curl_options'
+    'process_thumbnail', 'parse_bytes', 'set_curl_options', 'preallocate_file',
+    'append_file', 'calc_segment_size', 'CurlPool', 'curl_pool', 'probe_headers', 'HeadersCache', 'headers_cache'
 
 ]
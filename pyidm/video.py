@@ -11,12 +11,13 @@ import os
 import re
 import zipfile
 import time
-from urllib.parse import urljoin
 
 from . import config
-from .downloaditem import DownloadItem, Segment
+from .downloaditem import DownloadItem, SegmentList
 from .utils import log, validate_file_name, get_headers, size_format, run_command, size_splitter, get_seg_size, \
-    delete_file, download, process_thumbnail
+    delete_file, process_thumbnail, probe_headers, rename_file
+from .decryption import decryptor, get_iv, get_decrypted_file
+from .m3u8 import fetch_playlist, Key, InitSection
 
 # youtube-dl
 ytdl = None  # youtube-dl will be imported in a separate thread to save loading time
@@ -135,6 +136,11 @@ class Video(DownloadItem):
         all_streams = [Stream(x) for x in self.vid_info['formats']]
         all_streams.reverse()  # get higher quality first
 
+        # missing streams sizes are being fetched concurrently, wait for results
+        for stream in all_streams:
+            if stream.size_probe:
+                stream.size = stream.get_size()
+
         # prepare some categories
         normal_streams = {stream.raw_name: stream for stream in all_streams if stream.mediatype == 'normal'}
         dash_streams = {stream.raw_name: stream for stream in all_streams if stream.mediatype == 'dash'}
@@ -356,8 +362,12 @@ class Stream:
         if self.fragments or 'm3u8' in self.protocol:
             # ignore fragmented streams, since the size coming from headers is for first fragment not whole file
             self.size = 0
+
+        # request headers in background, streams of a video will be probed concurrently, result used in get_size()
+        self.size_probe = None
         if not isinstance(self.size, int):
-            self.size = self.get_size()
+            self.size_probe = probe_headers(self.url)
+            self.size = 0
 
         # hls stream specific
         self.manifest_url = stream_info.get('manifest_url', '')
@@ -365,7 +375,8 @@ class Stream:
         # print(self.name, self.size, isinstance(self.size, int))
 
     def get_size(self):
-        headers = get_headers(self.url)
+        probe, self.size_probe = self.size_probe, None
+        headers = probe.result() if probe else get_headers(self.url)
         size = int(headers.get('content-length', 0))
         print('stream.get_size()>', self.name)
         return size
@@ -552,156 +563,196 @@ def pre_process_hls(d):
             return False
 
     # download m3u8 files ----------------------------------------------------------------------------------------
-    def download_m3u8(url):
-        # download the manifest from m3u8 file descriptor located at url
-        buffer = download(url)  # get BytesIO object
+    dash = 'dash' in d.subtype_list
+    futures = {}  # key: url, value: Future object, every url is fetched once
 
-        if buffer:
-            # convert to string
-            buffer = buffer.getvalue().decode()
+    def fetch_m3u8(url):
+        # start downloading m3u8 file in background
+        if url and url not in futures:
+            futures[url] = fetch_playlist(url)
 
-            # verify file is m3u8 format
-            if '#EXT' in repr(buffer):
-                return buffer
+    def download_m3u8(url, media=True):
+        # wait for downloaded and parsed m3u8 file, unchanged playlists are not parsed again
+        fetch_m3u8(url)
+        playlist = futures[url].result() if url else None
 
-        log('pre_process_hls()> received invalid m3u8 file from server')
-        if config.log_level >= 3:
-            log('---------------------------------------\n', buffer, '---------------------------------------\n')
-        return None
+        if not playlist:
+            log('pre_process_hls()> received invalid m3u8 file from server', url)
+            return None
+
+        # a master playlist is not a media playlist even if received from the stream url
+        if playlist.is_master == media:
+            return None
 
-    # get correct url of m3u8 file from playlist or master m3u8 manifest, youtube-dl sometimes gives wrong url
-    def get_correct_m3u8_url(master_m3u8_doc, media='video'):
-        if not master_m3u8_doc:
+        return playlist
+
+    # get correct url of m3u8 file from master m3u8 manifest, youtube-dl sometimes gives wrong url
+    def get_correct_m3u8_url(master_playlist, media='video'):
+        if not master_playlist:
             return False
 
-        lines = master_m3u8_doc.splitlines()
-        for i, line in enumerate(lines):
+        selected = select_hls_variant(master_playlist, d, media=media)
+        return selected.url if selected else False
 
-            # video_checks = any([str(x) in line for x in (d.width, d.height, d.format_id) if x is not None])
-            # audio_checks = any([str(x) in line for x in (d.abr, d.tbr, d.audio_format_id) if x is not None])
+    # fetch all m3u8 files concurrently, master manifest is used only if stream urls are not valid media playlists
+    for url in (d.eff_url, d.audio_url if dash else None, d.manifest_url):
+        fetch_m3u8(url)
 
-            # todo: these checks are very fragile, we need to parse line into dict
-            video_checks = (str(d.width) in line and str(d.height) in line or d.format_id in line)
-            audio_checks = (str(d.abr) in line or str(d.tbr) in line or d.audio_format_id in line)
+    video_m3u8 = download_m3u8(d.eff_url)
+    audio_m3u8 = download_m3u8(d.audio_url) if dash else None
 
-            found = video_checks if media == 'video' else audio_checks
+    if not video_m3u8 or (dash and not audio_m3u8):
+        master_m3u8 = download_m3u8(d.manifest_url, media=False)
 
-            if found:
-                # url maybe in same line with "URI" notation or at the next line
-                match = re.search(r'URI="(.*)"', line)
-                if match:
-                    url = match.group(1)
-                elif not lines[i + 1].startswith('#'):
-                    url = lines[i + 1]
-                else:
-                    return False
+        if not video_m3u8:
+            eff_url = get_correct_m3u8_url(master_m3u8, media='video')
+            if not eff_url:
+                log('pre_process_hls()> Failed to get correct video m3u8 url, quitting!')
+                return False
+            else:
+                d.eff_url = eff_url
+                fetch_m3u8(d.eff_url)
+
+        if dash and not audio_m3u8:
+            eff_url = get_correct_m3u8_url(master_m3u8, media='audio')
+            if not eff_url:
+                log('pre_process_hls()> Failed to get correct audio m3u8 url, quitting!')
+                return False
+            else:
+                d.audio_url = eff_url
+                fetch_m3u8(d.audio_url)
 
-                correct_url = urljoin(d.manifest_url, url)
-                return correct_url
+        video_m3u8 = video_m3u8 or download_m3u8(d.eff_url)
+        audio_m3u8 = audio_m3u8 or (download_m3u8(d.audio_url) if dash else None)
 
-    master_m3u8 = download_m3u8(d.manifest_url)
-    video_m3u8 = download_m3u8(d.eff_url)
-    audio_m3u8 = download_m3u8(d.audio_url)
+    if not video_m3u8 or (dash and not audio_m3u8):
+        log('pre_process_hls()> Failed to get media m3u8 files, quitting!')
+        return False
 
-    if not video_m3u8:
-        eff_url = get_correct_m3u8_url(master_m3u8, media='video')
-        if not eff_url:
-            log('pre_process_hls()> Failed to get correct video m3u8 url, quitting!')
-            return False
-        else:
-            d.eff_url = eff_url
-            video_m3u8 = download_m3u8(d.eff_url)
+    # decrypt AES-128 segments as soon as they are downloaded instead of letting ffmpeg decrypt them later
+    decrypt = config.hls_decrypt and decryptor.available and can_decrypt_hls(video_m3u8) and \
+        ('dash' not in d.subtype_list or can_decrypt_hls(audio_m3u8))
+    d.hls_keys = {}
 
-    if 'dash' in d.subtype_list and not audio_m3u8:
-        eff_url = get_correct_m3u8_url(master_m3u8, media='audio')
-        if not eff_url:
-            log('pre_process_hls()> Failed to get correct audio m3u8 url, quitting!')
-            return False
-        else:
-            d.audio_url = eff_url
-            audio_m3u8 = download_m3u8(d.audio_url)
+    # join media segments in order while downloading, instead of letting ffmpeg process thousands of files later
+    d.hls_concat = config.hls_concat and can_concatenate_hls(video_m3u8, decrypt) and \
+        ('dash' not in d.subtype_list or can_concatenate_hls(audio_m3u8, decrypt))
 
     # save remote m3u8 files to disk
     with open(os.path.join(d.temp_folder, 'remote_video.m3u8'), 'w') as f:
-        f.write(video_m3u8)
+        f.write(video_m3u8.text)
 
     if 'dash' in d.subtype_list:
         with open(os.path.join(d.temp_folder, 'remote_audio.m3u8'), 'w') as f:
-            f.write(audio_m3u8)
+            f.write(audio_m3u8.text)
 
     # ---------------------------------------------------------------------------------------------------------
 
     # process remote m3u8 files -------------------------------------------------------------------------------
-    def process_m3u8(file, type_='video'):
+    def process_m3u8(playlist, type_='video'):
         """
-        process m3u8 file, extract urls, build local m3u8 file, and build segments for download item
-        :param file: m3u8 as a file object
+        process parsed m3u8 playlist, build local m3u8 file, and build segments for download item
+        :param playlist: m3u8.Playlist object
         :param type_: 'video' or 'audio'
         :return: None
         """
 
-        base_url = d.eff_url if type_=='video' else d.audio_url
         seg_name = 'v' if type_ == 'video' else 'a'
 
-        url_list = []
-        local_lines = []
-        local_lines2 = []
-        lines = file.splitlines()
-
-        # iterate over all m3u8 file lines
-        for i, line in enumerate(lines[:]):
-            url = ''
-            line2 = line
-
-            # lines doesn't start with # is a media links
-            if line and not line.startswith('#'):
-                # get absolute url from relative paths
-                url = urljoin(base_url, line)
-                line2 = url
-
-                # build line for local m3u8 file with reference to local segment file
-                line = os.path.join(d.temp_folder, f'{seg_name}{i}')
-
-            # handle buried urls inside lines ex: # '#EXT-X-KEY:METHOD=AES-128,URI="https://content-aus...62a9",IV=0x0000'
-            elif line.startswith('#'):
-                match = re.search(r'URI="(.*)"', line)
-                if match:
-                    url = match.group(1)
-                    # get absolute url from relative paths
-                    url = urljoin(base_url, url)
-
-                    line2 = line.replace(match.group(1), url)
-                    line = line.replace(match.group(1), os.path.join(d.temp_folder, f'{seg_name}{i}'))
+        # local m3u8 file refers to local segment files, remote2 m3u8 file has absolute urls for debugging
+        local_lines = playlist.lines[:]
+        remote_lines = playlist.lines[:]
+
+        # files to be downloaded, key: line index in playlist, value: [url, byte range start, byte range end] where
+        # start / end are None for whole files, line index is used in segment name
+        urls = {}
+
+        # byte range segments, adjacent ranges of the same url will be downloaded as one request up to segment size
+        max_size = config.segment_size
+        group = None  # line index of last byte range request which can be extended
+
+        def get_local_file(i):
+            # process name and convert '\' to '/'
+            return os.path.join(d.temp_folder, f'{seg_name}{i}').replace('\\', '/')
+
+        # handle buried urls inside lines ex: # '#EXT-X-KEY:METHOD=AES-128,URI="https://content-aus...62a9",IV=0x0000'
+        for item in playlist.keys + playlist.init_sections:
+            if not item.uri:
+                continue
+
+            line = playlist.lines[item.line]
+            remote_lines[item.line] = line.replace(item.uri, item.url)
+
+            # keys will be handled by decryptor, segments in local m3u8 file will be plain media
+            if decrypt and isinstance(item, Key):
+                local_lines[item.line] = None
+                continue
+
+            local_lines[item.line] = line.replace(item.uri, get_local_file(item.line))
+            urls[item.line] = [item.url, None, None]
+
+            # initialization section as a sub-range of a file, local file will have this range only
+            if isinstance(item, InitSection) and item.byterange:
+                length, offset = item.byterange
+                urls[item.line][1:] = [offset, offset + length]
+                local_lines[item.line] = re.sub(r'BYTERANGE="[^"]*"', f'BYTERANGE="{length}@0"', local_lines[item.line])
+
+            # encrypted initialization section, iv is the media sequence number of the following segment
+            if decrypt and isinstance(item, InitSection) and item.key:
+                d.hls_keys[os.path.join(d.temp_folder, f'{seg_name}{item.line}')] = \
+                    (item.key.url, get_iv(item.key.iv, item.sequence))
+                local_lines[item.line] = local_lines[item.line].replace(get_local_file(item.line),
+                                                                        get_decrypted_file(get_local_file(item.line)))
+
+        for seg in playlist.segments:
+            remote_lines[seg.line] = seg.url
+
+            if seg.byterange:
+                length, offset = seg.byterange
+                url, start, end = urls[group] if group is not None else (None, None, None)
+
+                # encrypted segments are not joined since each one is decrypted separately
+                if url == seg.url and end == offset and offset + length - start <= max_size and not seg.key:
+                    urls[group][2] = offset + length
+                else:
+                    group = seg.line if not seg.key else None
+                    start = offset
+                    urls[seg.line] = [seg.url, offset, offset + length]
 
-            # process line and convert '\' to '/'
-            line = line.replace('\\', '/')
-            line2 = line2.replace('\\', '/')
+                # local file of a joined request has the ranges of all its segments, offsets are relative to its start
+                local_lines[seg.line] = get_local_file(group if group is not None else seg.line)
+                local_lines[seg.byterange_line] = f'#EXT-X-BYTERANGE:{length}@{offset - start}'
 
-            local_lines2.append(line2)
-            local_lines.append(line)
+            else:
+                group = None
+                local_lines[seg.line] = get_local_file(seg.line)
+                urls[seg.line] = [seg.url, None, None]
 
-            url_list.append(url)
+            if decrypt and seg.key:
+                d.hls_keys[os.path.join(d.temp_folder, f'{seg_name}{seg.line}')] = \
+                    (seg.key.url, get_iv(seg.key.iv, seg.sequence))
+                local_lines[seg.line] = get_decrypted_file(get_local_file(seg.line))
 
         # write m3u8 file with absolute paths for debugging
         name = 'remote_video2.m3u8' if type_ == 'video' else 'remote_audio2.m3u8'
-        local_file = os.path.join(d.temp_folder, name)
-        with open(os.path.join(d.temp_folder, local_file), 'w') as f:
-            f.write('\n'.join(local_lines2))
+        with open(os.path.join(d.temp_folder, name), 'w') as f:
+            f.write('\n'.join(remote_lines))
 
         # write local m3u8 file
         name = 'local_video.m3u8' if type_ == 'video' else 'local_audio.m3u8'
-        local_file = os.path.join(d.temp_folder, name)
-        with open(os.path.join(d.temp_folder, local_file), 'w') as f:
-            f.write('\n'.join(local_lines))
+        with open(os.path.join(d.temp_folder, name), 'w') as f:
+            f.write('\n'.join(line for line in local_lines if line is not None))
 
-        # create segments
-        seg_name = 'v' if type_ == 'video' else 'a'
-        d._segments += [Segment(name=os.path.join(d.temp_folder, f'{seg_name}{i}'), num=i, range=None, size=0,
-                                url=seg_url, tempfile=d.temp_file, merge=False)
-                        for i, seg_url in enumerate(url_list) if seg_url]
+        # create segments in playlist order, if concatenation is possible segments will be merged into one stream file
+        tempfile = get_hls_stream_file(d, type_) if d.hls_concat else d.temp_file
+        for i in sorted(urls):
+            url, start, end = urls[i]
+            d._segments.add(name=os.path.join(d.temp_folder, f'{seg_name}{i}'), num=i,
+                            range=f'{start}-{end - 1}' if end else None, size=end - start if end else 0,
+                            url=url, tempfile=tempfile, merge=d.hls_concat)
 
     # reset segments
-    d._segments = []
+    d.segments = SegmentList()
 
     # send video m3u8 file for processing
     process_m3u8(video_m3u8, type_='video')
@@ -713,16 +764,122 @@ def pre_process_hls(d):
     # load previous segment information from disk - resume download -
     d.load_progress_info()
 
+    # stream files must contain completed segments only, otherwise segments will be appended twice
+    if d.hls_concat:
+        verify_hls_streams(d)
+
     log('pre_process_hls()> done processing', d.name)
 
     return True
 
 
+def select_hls_variant(master_playlist, d, media='video'):
+    """return variant or rendition of a master playlist matching download item stream attributes, or None
+    youtube-dl "tbr" is variant BANDWIDTH / 1000, and format_id of an audio rendition ends with its NAME"""
+
+    if media == 'audio':
+        for rendition in master_playlist.renditions:
+            if rendition.type == 'AUDIO' and rendition.url and d.audio_format_id and \
+                    d.audio_format_id.endswith(f'-{rendition.name}'):
+                return rendition
+
+        bitrates = [x for x in (d.abr, d.tbr) if x]
+        for variant in master_playlist.variants:
+            if variant.bandwidth and variant.bandwidth / 1000 in bitrates:
+                return variant
+
+        return None
+
+    # exact bandwidth match
+    for variant in master_playlist.variants:
+        if d.tbr and variant.bandwidth / 1000 == d.tbr:
+            return variant
+
+    # same resolution, nearest bandwidth
+    candidates = [v for v in master_playlist.variants if v.resolution and v.resolution == (d.width, d.height)]
+    if candidates:
+        return min(candidates, key=lambda v: abs(v.bandwidth - (d.tbr or 0) * 1000))
+
+    return None
+
+
+def can_decrypt_hls(playlist):
+    """return True if all keys in a m3u8 media playlist are AES-128 keys which can be handled by decryptor,
+    other methods i.e. SAMPLE-AES or key formats will be left for ffmpeg"""
+    for key in playlist.keys:
+        if key.method != 'NONE' and (key.method != 'AES-128' or not key.url or key.keyformat != 'identity'):
+            return False
+
+    return True
+
+
+def can_concatenate_hls(playlist, decrypt=False):
+    """return True if media segments of a m3u8 media playlist can be joined in order into a single stream file,
+    it works for MPEG-TS segments and fMP4 segments with one initialization section "#EXT-X-MAP", including byte
+    range segments, but not for encrypted segments
+    :param decrypt: if True, AES-128 segments will be decrypted before joining
+    """
+    for key in playlist.keys:
+        if key.method != 'NONE' and not (decrypt and key.method == 'AES-128'):
+            return False
+
+    return len(playlist.init_sections) <= 1
+
+
+def get_hls_stream_file(d, type_='video'):
+    """return file name for concatenated hls segments of a stream"""
+    return os.path.join(d.temp_folder, f'{type_}_stream')
+
+
+def verify_hls_streams(d):
+    """match stream files of concatenated hls segments with loaded progress info when resuming,
+    data merged after last saved progress will be truncated, and a stream file shorter than its completed segments
+    i.e. progress info is lost, will be deleted and its segments will be merged or downloaded again"""
+    streams = {}  # key: stream file, value: list of segments
+    for seg in d.segments:
+        streams.setdefault(seg.tempfile, []).append(seg)
+
+    rescan = False
+    for file, segments in streams.items():
+        merged = sum(seg.written for seg in segments if seg.completed)
+        size = os.path.getsize(file) if os.path.isfile(file) else 0
+
+        if size == merged:
+            continue
+
+        if size > merged:
+            log('verify_hls_streams()> truncate', os.path.basename(file), 'from', size, 'to', merged, 'bytes')
+            os.truncate(file, merged)
+            continue
+
+        log('verify_hls_streams()> incomplete stream file', os.path.basename(file), size, 'bytes, expected:', merged)
+        delete_file(file)
+        rescan = True
+
+        for seg in segments:
+            if seg.completed:
+                seg.completed = False
+
+                # merged segment file is already deleted
+                if not os.path.isfile(seg.name):
+                    seg.written = 0
+                    seg.decrypted = False
+                    seg.downloaded = False
+
+    # update downloaded bytes
+    if rescan:
+        d.scan_segments()
+
+
 def post_process_hls(d):
     """ffmpeg will process m3u8 files"""
 
     log('post_process_hls()> start processing', d.name)
 
+    # segments already concatenated in stream files, only change container if required
+    if d.hls_concat:
+        return remux_hls(d)
+
     local_video_m3u8_file = os.path.join(d.temp_folder, 'local_video.m3u8')
     local_audio_m3u8_file = os.path.join(d.temp_folder, 'local_audio.m3u8')
 
@@ -748,6 +905,34 @@ def post_process_hls(d):
     return True
 
 
+def remux_hls(d):
+    """convert concatenated hls stream files to mp4 container, ffmpeg is not needed if target file is a ts file"""
+    streams = [(get_hls_stream_file(d, 'video'), d.temp_file)]
+    if 'dash' in d.subtype_list:
+        streams.append((get_hls_stream_file(d, 'audio'), d.audio_file))
+
+    for stream_file, out_file in streams:
+        # MPEG-TS segments joined together is a valid ts file, ts packets start with sync byte 0x47
+        if len(streams) == 1 and os.path.splitext(d.target_file)[1].lower() == '.ts':
+            with open(stream_file, 'rb') as f:
+                is_ts = f.read(1) == b'\x47'
+
+            if is_ts:
+                rename_file(stream_file, out_file)
+                continue
+
+        cmd = f'"{config.ffmpeg_actual_path}" -y -i "file:{stream_file}" -c copy -f mp4 "file:{out_file}"'
+
+        error, output = run_command(cmd, d=d)
+        if error:
+            log('remux_hls()> ffmpeg failed:', output)
+            return False
+
+    log('remux_hls()> done processing', d.name)
+
+    return True
+
+
 def convert_audio(d):
     """
     convert audio formats
@@ -9,18 +9,23 @@
 
 # worker class
 import os
+import time
 import pycurl
 
+from . import config
 from .config import Status
-from .utils import log, set_curl_options
+from .utils import log, set_curl_options, curl_pool
+from .limiter import limiter
 
 
 class Worker:
-    def __init__(self, tag=0, d=None):
+    def __init__(self, tag=0, d=None, multiplex=False):
         self.tag = tag
         self.d = d
+        self.multiplex = multiplex  # request http2 and wait for a connection which can be multiplexed
         self.q = d.q
         self.seg = None
+        self.url = None  # segment url or a mirror url
         self.resume_range = None
 
         # writing data parameters
@@ -29,12 +34,36 @@ class Worker:
 
         self.downloaded = 0
         self.start_size = 0  # initial file size before start resuming
+        self.committed = 0  # sparse segment size saved in progress journal
 
-        # connection parameters
-        self.c = pycurl.Curl()
-        self.speed_limit = 0
+        # total bytes received by this worker, added to download item downloaded value, it is updated only from
+        # worker's own transfer, so no locking required
+        self.received = 0
+
+        # write buffer, received data will be collected then written to file in big chunks
+        self.buffer = None
+        self.buffer_view = None
+        self.buffered = 0  # number of bytes waiting in buffer
+
+        # speed limiter token buckets of this download, and received bytes not charged to buckets yet
+        self.buckets = None
+        self.unpaid = 0
+
+        # True while worker has a segment assigned, it will be reset when transfer is done
+        self.busy = False
+
+        # connection parameters, curl handle from connections pool, it will be returned to pool in close()
+        self.c = curl_pool.get(d.eff_url or d.url)
+        self.engine = None  # curl multi engine running this worker's transfer or None if it runs in its own thread
         self.headers = {}
 
+        # last transfer statistics
+        self.response_code = 0
+        self.error = None
+        self.speed = 0  # average download speed in bytes/sec reported by curl
+        self.total_time = 0  # in seconds
+        self.ttfb = 0  # time to first byte in seconds
+
     def debug(self, *args, log_level=2):
         args = [repr(arg) for arg in args]
         msg = '>> ' + ' '.join(args)
@@ -51,15 +80,37 @@ class Worker:
     def current_filesize(self):
         return self.start_size + self.downloaded
 
-    def reuse(self, seg=None, speed_limit=0):
-        """Recycle same object again, better for performance as recommended by curl docs"""
+    @property
+    def remaining(self):
+        """remaining bytes of current segment, zero if segment size is unknown"""
+        if not self.seg or not self.seg.size:
+            return 0
+        return max(self.seg.size - self.current_filesize, 0)
+
+    def done(self):
+        """mark worker as free and wake up thread manager"""
+        self.busy = False
+        self.q.thread_mngr.put(self.tag)
+
+    def close(self):
+        """return curl handle to connections pool, worker mustn't be used after that"""
+        if self.c:
+            curl_pool.put(self.c, self.d.eff_url or self.d.url)
+            self.c = None
+
+    def reuse(self, seg=None, url=None):
+        """Recycle same object again, better for performance as recommended by curl docs
+        :param url: download segment from a mirror url instead of segment url
+        """
         self.reset()
 
         self.seg = seg
-        self.speed_limit = speed_limit
+        self.url = url or seg.url
+        self.busy = True
+        self.buckets = limiter.get_buckets(self.d)
 
         self.debug('worker', self.tag, 'start seg:', os.path.basename(self.seg.name), 'range:', self.seg.range, 'size:',
-                   self.seg.size, 'SL=', self.speed_limit)
+                   self.seg.size)
 
         self.check_previous_download()
 
@@ -72,30 +123,49 @@ class Worker:
         self.file = None
         self.mode = 'wb'  # file opening mode default to new write binary
         self.downloaded = 0
+        self.committed = 0
+        self.buffered = 0
+        self.unpaid = 0
         self.resume_range = None
+        self.headers = {}
+        self.response_code = 0
+        self.error = None
+        self.speed = 0
+        self.total_time = 0
+        self.ttfb = 0
 
     def check_previous_download(self):
+        # sparse segment is written into a shared temp file, its progress is stored in segment itself
+        if self.seg.sparse:
+            self.start_size = self.committed = self.seg.written
+            self.mode = 'r+b'  # file opening mode for writing at segment offset
+
         # get start file size if this segment file partially downloaded before
-        if os.path.exists(self.seg.name):
-            with open(self.seg.name, 'rb') as f:
-                self.start_size = len(f.read())
+        else:
+            try:
+                self.start_size = os.stat(self.seg.name).st_size
+            except OSError:
+                self.start_size = 0
+            self.seg.written = self.start_size
 
-            if not self.seg.size:
+            if self.start_size and not self.seg.size:
                 # in this case we will overwrite previous download, reset startsize and remove value from d.downloaded
                 self.mode = 'wb'
-                self.d.downloaded -= self.start_size
+                self.received -= self.start_size
                 self.debug(self.seg.num, 'overwrite the previous download, start size =', self.start_size)
-                self.start_size = 0
+                self.start_size = self.seg.written = 0
                 return
 
         # no previous file existed - start fresh file
         if not self.current_filesize:
-            self.mode = 'wb'
+            if not self.seg.sparse:
+                self.mode = 'wb'
 
         elif self.current_filesize == self.seg.size:  # segment is completed before
             # self.report_completed()
             self.debug('worker', self.tag, ': File', self.seg.num, 'already completed before')
             self.seg.downloaded = True
+            self.q.completed_jobs.put(self.seg)
 
         # in case the server sent extra bytes from last session by mistake, truncate file
         elif self.current_filesize > self.seg.size:
@@ -103,17 +173,19 @@ class Worker:
                        f"will be truncated to: {self.seg.size}")
 
             # truncate file
-            with open(self.seg.name, 'rb+') as f:
-                f.truncate(self.seg.size)
+            if not self.seg.sparse:
+                os.truncate(self.seg.name, self.seg.size)
+            self.seg.written = self.seg.size
             # self.report_completed()
             self.seg.downloaded = True
+            self.q.completed_jobs.put(self.seg)
 
         # should resume with new range
         elif self.current_filesize < self.seg.size and self.seg.range:
             # set new range and file open mode
-            a, b = [int(x) for x in self.seg.range.split('-')]
-            self.resume_range = f'{a + self.current_filesize}-{b}'
-            self.mode = 'ab'  # open file for append
+            self.resume_range = f'{self.seg.start + self.current_filesize}-{self.seg.end}'
+            if not self.seg.sparse:
+                self.mode = 'ab'  # open file for append
 
             # report
             self.debug('Seg', self.seg.num, 'resuming, new range:', self.resume_range,
@@ -121,9 +193,9 @@ class Worker:
 
         elif not self.seg.range:
             self.mode = 'wb'
-            self.d.downloaded -= self.start_size
+            self.received -= self.start_size
             self.debug(self.seg.num, 'overwrite the previous download, start size =', self.start_size)
-            self.start_size = 0
+            self.start_size = self.seg.written = 0
 
     def verify(self):
         """check if segment completed"""
@@ -136,37 +208,50 @@ class Worker:
     def report_not_completed(self):
         self.debug('worker', self.tag, 'did not complete', os.path.basename(self.seg.name), 'done',
                    self.current_filesize, 'target size:', self.seg.size, 'left:',
-                   self.seg.size - self.current_filesize, 'url:', self.seg.url)
+                   self.seg.size - self.current_filesize, 'url:', self.url)
 
         # put back to jobs queue to try again
         self.q.jobs.put(self.seg)
 
     def report_completed(self):
         # self.debug('worker', self.tag, 'completed', self.seg.name)
-        self.seg.downloaded = True
-
-        self.debug('downloaded segment:', os.path.basename(self.seg.name))
-
         # in case couldn't fetch segment size from headers we put the downloaded length as segment size
         if not self.seg.size:
             self.seg.size = self.downloaded
         # print(self.headers)
 
+        self.seg.downloaded = True
+        self.q.completed_jobs.put(self.seg)
+
+        self.debug('downloaded segment:', os.path.basename(self.seg.name))
+
     def set_options(self):
 
         # set general curl options
         set_curl_options(self.c)
 
-        self.c.setopt(pycurl.URL, self.seg.url)
+        self.c.setopt(pycurl.URL, self.url)
+
+        # no total time limit, big segments or speed limit might need more than general curl timeout, stalled
+        # transfers are still aborted by low speed limit options
+        self.c.setopt(pycurl.TIMEOUT, 0)
 
-        range_ = self.resume_range or self.seg.range
+        range_ =self.resume_range or self.seg.range
         if range_:
             self.c.setopt(pycurl.RANGE, range_)  # download segment only not the whole file
+        else:
+            self.c.unsetopt(pycurl.RANGE)  # reused handle might still have range of a previous segment
 
         self.c.setopt(pycurl.NOPROGRESS, 0)  # will use a progress function
 
-        # set speed limit selected by user
-        self.c.setopt(pycurl.MAX_RECV_SPEED_LARGE, self.speed_limit)  # cap download speed to n bytes/sec, 0=disabled
+        # http2 streams, prefer waiting for an existing connection to be multiplexed over opening a new connection
+        if self.multiplex:
+            self.c.setopt(pycurl.HTTP_VERSION, pycurl.CURL_HTTP_VERSION_2TLS)
+            self.c.setopt(pycurl.PIPEWAIT, 1)
+
+        # bigger receive buffer means less calls to write callback
+        if config.curl_buffer_size:
+            self.c.setopt(pycurl.BUFFERSIZE, config.curl_buffer_size)
 
         # verbose
         self.c.setopt(pycurl.VERBOSE, 0)
@@ -180,6 +265,14 @@ class Worker:
         header_line = header_line.decode('iso-8859-1')
         header_line = header_line.lower()
 
+        # status line i.e. "http/1.1 206 partial content", there will be more than one in case of redirections
+        if header_line.startswith('http/'):
+            try:
+                self.response_code = int(header_line.split()[1])
+            except:
+                pass
+            return
+
         if ':' not in header_line:
             return
 
@@ -189,7 +282,7 @@ class Worker:
         self.headers[name] = value
 
         # update segment size if not available
-        if not self.seg.size and name == 'content-length':
+        if not self.seg.size and name == 'content-length' and self.response_code < 400:
             try:
                 self.seg.size = int(self.headers.get('content-length', 0))
                 # print('self.seg.size = ', self.seg.size)
@@ -205,10 +298,11 @@ class Worker:
         if self.d.status != Status.downloading:
             return -1  # abort
 
-    def run(self):
+    def prepare(self):
+        """set curl options and open segment file, return False if there is nothing to download"""
         # check if file completed before and exit
         if self.seg.downloaded:
-            return
+            return False
 
         self.set_options()
 
@@ -218,9 +312,58 @@ class Worker:
             if not os.path.isdir(target_directory):
                 os.makedirs(target_directory)  # it will also create any intermediate folders in the given path
 
-            with open(self.seg.name, self.mode) as self.file:
-                self.c.perform()
+            # allocate write buffer once, and re-allocate only if buffer size setting changed
+            buffer_size = config.write_buffer_size
+            if not buffer_size:
+                self.buffer = self.buffer_view = None
+            elif not self.buffer or len(self.buffer) != buffer_size:
+                self.buffer = bytearray(buffer_size)
+                self.buffer_view = memoryview(self.buffer)
+
+            if self.seg.sparse:
+                # write directly into preallocated temp file at segment offset, unbuffered to make sure segment
+                # written bytes saved in progress journal never exceed the actual data in file
+                self.file = open(self.seg.tempfile, self.mode, buffering=0)
+                self.file.seek(self.seg.offset + self.current_filesize)
+            else:
+                # no need for file object buffering if we are using our own write buffer
+                self.file = open(self.seg.name, self.mode, buffering=0 if self.buffer else -1)
+
+            return True
 
+        except Exception as e:
+            log('worker', self.tag, ': quitting ...', repr(e), self.url, log_level=2)
+            self.report_not_completed()
+            return False
+
+    def finish(self, error=None):
+        """close segment file and report segment status, called after curl transfer is done or failed
+        :param error: curl error or error message if transfer failed
+        """
+        try:
+            self.flush_buffer()
+        except Exception as e:
+            error = error or f'failed writing to file: {e}'
+
+        try:
+            self.file.close()
+        except:
+            pass
+
+        if self.seg.sparse:
+            self.seg.commit()
+
+        # transfer statistics
+        self.error = error
+        try:
+            self.response_code = self.c.getinfo(pycurl.RESPONSE_CODE) or self.response_code
+            self.speed = self.c.getinfo(pycurl.SPEED_DOWNLOAD)
+            self.total_time = self.c.getinfo(pycurl.TOTAL_TIME)
+            self.ttfb = self.c.getinfo(pycurl.STARTTRANSFER_TIME)
+        except:
+            pass
+
+        if error is None:
             # print('worker', self.tag, 'curl done')
 
             completed = self.verify()
@@ -229,30 +372,132 @@ class Worker:
             else:
                 self.report_not_completed()
 
-            response_code = self.c.getinfo(pycurl.RESPONSE_CODE)
-            if response_code in range(400, 512):
-                self.debug('server refuse connection', response_code, 'cancel download and try to refresh link')
+            if self.response_code in range(400, 512):
+                self.debug('server refuse connection', self.response_code, 'cancel download and try to refresh link')
 
-        except Exception as e:
-            if any(statement in repr(e) for statement in ('Failed writing body', 'Callback aborted')):
+        # transfer aborted by write() after receiving the whole segment, extra bytes from server are discarded
+        elif self.seg.size and self.current_filesize == self.seg.size:
+            self.report_completed()
+
+        else:
+            if self.response_code in range(400, 512):
+                error = f'server refuse connection {self.response_code}'
+                log('worker', self.tag, error, self.url, log_level=2)
+            elif any(statement in repr(error) for statement in ('Failed writing body', 'Callback aborted')):
                 error = f'terminated by user'
                 log('worker', self.tag, error, log_level=2)
             else:
-                error = repr(e)
-                log('worker', self.tag, ': quitting ...', error, self.seg.url, log_level=2)
+                error = repr(error)
+                log('worker', self.tag, ': quitting ...', error, self.url, log_level=2)
 
             self.report_not_completed()
 
+        self.done()
+
+    def run(self):
+        """download segment using curl easy interface, it will block until segment transfer is done"""
+        self.engine = None
+
+        if not self.prepare():
+            self.done()
+            return
+
+        try:
+            self.c.perform()
+            self.finish()
+        except Exception as e:
+            self.finish(error=e)
+
     def write(self, data):
         """write to file"""
-        self.file.write(data)
-        self.downloaded += len(data)
-
-        self.d.downloaded += len(data)
+        # server error, don't write error page into segment file
+        if self.response_code >= 400:
+            return -1  # abort
 
-        # check if we getting over sized
-        if self.current_filesize > self.seg.size > 0:
+        # speed limit, bucket rates are read without locking, buckets are charged and checked once per batch
+        limited = self.buckets[0].rate or self.buckets[1].rate
+        if limited and self.unpaid >= limiter.batch_size:
+            self.pay()
+            wait = limiter.delay(self.buckets)
+            if wait:
+                if self.engine:
+                    # engine thread can't be blocked, pause transfer and curl will pass the same data again after
+                    # resuming
+                    self.engine.pause(self, wait)
+                    return pycurl.WRITEFUNC_PAUSE
+
+                while wait and self.d.status == Status.downloading:
+                    time.sleep(min(wait, 0.5))
+                    wait = limiter.delay(self.buckets)
+
+        # check if we getting over sized, write only the remaining bytes of this segment then abort
+        oversized = False
+        size = len(data)
+        if self.seg.size > 0 and self.current_filesize + size > self.seg.size:
+            size = max(self.seg.size - self.current_filesize, 0)
+            data = data[:size]
+            oversized = True
+
+        if limited:
+            self.unpaid += size
+
+        if self.buffer:
+            # flush if there is no room for new data
+            if self.buffered + size > len(self.buffer):
+                self.flush_buffer()
+
+            if size <= len(self.buffer):
+                self.buffer_view[self.buffered:self.buffered + size] = data
+                self.buffered += size
+                self.downloaded += size
+                return -1 if oversized else None
+
+        self.write_file(data)
+        self.downloaded += size
+        self.received += size
+        self.update_written()
+
+        if oversized:
             return -1  # abort
 
+    def pay(self):
+        """charge speed limiter buckets for received bytes"""
+        if self.unpaid:
+            limiter.consume(self.buckets, self.unpaid)
+            self.unpaid = 0
+
+    def flush_buffer(self):
+        """write buffered data to file and update counters"""
+        self.pay()
+
+        if self.buffered:
+            try:
+                self.write_file(self.buffer_view[:self.buffered])
+                self.received += self.buffered
+            except:
+                # data is lost, it will be downloaded again
+                self.downloaded -= self.buffered
+                raise
+            finally:
+                self.buffered = 0
+
+        self.update_written()
+
+    def write_file(self, data):
+        """write all data to file, unbuffered file objects might write less than the given data"""
+        data = memoryview(data)
+        while data:
+            data = data[self.file.write(data):]
+
+    def update_written(self):
+        """update segment written bytes, must be called after data is written to file"""
+        self.seg.written = self.current_filesize - self.buffered
+
+        if self.seg.sparse:
+            # save progress to journal periodically
+            if self.seg.written - self.committed >= config.journal_sync_size:
+                self.seg.commit()
+                self.committed = self.seg.written
+
 
 